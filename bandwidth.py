@@ -0,0 +1,133 @@
+import time
+import asyncio
+from config import Config
+
+class TokenBucket:
+    """Token bucket allowing `rate` bytes per second with bursts up to `burst`"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def set_rate(self, rate):
+        self.refill()
+        self.rate = rate
+        self.burst = rate
+        self.tokens = min(self.tokens, self.burst)
+
+    def delay(self):
+        """Seconds until the bucket is out of debt"""
+        return -self.tokens / self.rate if self.tokens < 0 and self.rate > 0 else 0
+
+class BandwidthShare:
+    """One transfer's slice of a BandwidthScheduler"""
+
+    def __init__(self, scheduler, user_id):
+        self.scheduler = scheduler
+        self.user_id = user_id
+        self.bucket = TokenBucket(scheduler.rate)
+
+    @property
+    def rate(self):
+        return self.bucket.rate
+
+    async def throttle(self, nbytes):
+        await self.scheduler.throttle(self, nbytes)
+
+    def close(self):
+        self.scheduler.unregister(self)
+
+class BandwidthScheduler:
+    """Global token bucket shared fairly between users and their transfers"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.bucket = TokenBucket(rate) if rate > 0 else None
+        self.shares = []
+
+    @property
+    def enabled(self):
+        return self.bucket is not None
+
+    def register(self, user_id=None):
+        """Start accounting a new transfer"""
+        share = BandwidthShare(self, user_id)
+        self.shares.append(share)
+        self._rebalance()
+        return share
+
+    def unregister(self, share):
+        """Stop accounting a finished transfer"""
+        if share in self.shares:
+            self.shares.remove(share)
+            self._rebalance()
+
+    def _rebalance(self):
+        if not self.enabled or not self.shares:
+            return
+        users = {}
+        for share in self.shares:
+            users.setdefault(share.user_id, []).append(share)
+        user_rate = self.rate / len(users)
+        for shares in users.values():
+            for share in shares:
+                share.bucket.set_rate(user_rate / len(shares))
+
+    def _charge(self, share, nbytes):
+        """Take nbytes from the buckets, returning how long to wait"""
+        self.bucket.refill()
+        delay = 0
+        if share is not None:
+            share.bucket.refill()
+            borrowing = share.bucket.tokens < nbytes and self.bucket.tokens - nbytes >= self.bucket.burst / 2
+            if not borrowing:
+                share.bucket.tokens -= nbytes
+                delay = share.bucket.delay()
+        self.bucket.tokens -= nbytes
+        return max(delay, self.bucket.delay())
+
+    async def throttle(self, share, nbytes):
+        """Wait until nbytes may be transferred"""
+        if not self.enabled or nbytes <= 0:
+            return
+        delay = self._charge(share, nbytes)
+        if delay > 0.001:
+            await asyncio.sleep(delay)
+
+    def account(self, share, nbytes):
+        """Record bytes moved by a transfer that limits itself (e.g. libtorrent)"""
+        if self.enabled and nbytes > 0:
+            self._charge(share, nbytes)
+
+    def limit_for(self, share):
+        """Rate a self-limiting transfer may use right now, 0 meaning unlimited"""
+        if not self.enabled or share is None:
+            return 0
+        self.bucket.refill()
+        if self.bucket.tokens >= self.bucket.burst / 2:
+            return int(self.rate)
+        return max(1, int(share.rate))
+
+    def progress_throttle(self, share, callback=None):
+        """Wrap a Pyrogram progress callback so the upload itself is throttled"""
+        state = {'last': 0}
+
+        async def progress(current, total, *args):
+            delta = current - state['last']
+            state['last'] = current
+            await self.throttle(share, delta)
+            if callback:
+                await callback(current, total, *args)
+
+        return progress
+
+# Download and upload directions are limited independently
+download_bandwidth = BandwidthScheduler(Config.SPEED_LIMIT)
+upload_bandwidth = BandwidthScheduler(Config.UPLOAD_SPEED_LIMIT)
@@ -8,12 +8,16 @@ from pyrogram.enums import ParseMode
 from config import Config  
 from database import db  
 from downloader import downloader  
+from bandwidth import upload_bandwidth
+from torrent import wanted_files
+from jobs import scheduler, QueueFull, CancelToken
 from helpers import (  
     Progress, humanbytes, is_url, is_magnet,   
     is_video_file, get_file_extension, sanitize_filename  
 )  
 import time  
 import random  
+import itertools
   
 # Initialize bot  
 app = Client(  
@@ -25,15 +29,46 @@ app = Client(
   
 # User settings and tasks storage  
 user_settings = {}  
-user_tasks = {}  
+user_tasks = {}  # user_id -> {task id: finished download waiting for the user's choice}
 user_cooldowns = {}  
+file_pickers = {}  # (chat id, status message id) -> open torrent file picker
+task_ids = itertools.count(1)
   
 # Cooldown settings  
 COOLDOWN_TIME = 159  # 2 minutes 39 seconds  
+
+# Torrent file picker
+PICKER_PAGE_SIZE = 8  # Files per page of buttons
+PICKER_TIMEOUT = 300  # Seconds to choose before the download is dropped
   
 # Welcome image URL  
 WELCOME_IMAGE = "https://envs.sh/xSn.gif"  
 
+def add_user_task(user_id, task):
+    """Keep a result until the user picks what to do with it, returns its id"""
+    task['id'] = str(next(task_ids))
+    user_tasks.setdefault(user_id, {})[task['id']] = task
+    return task['id']
+
+def pop_user_task(user_id, task_id):
+    tasks = user_tasks.get(user_id, {})
+    task = tasks.pop(task_id, None)
+    if not tasks:
+        user_tasks.pop(user_id, None)
+    return task
+
+def upload_buttons(task_id):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("📤 Upload as Original", callback_data=f"upload_original_{task_id}")],
+        [InlineKeyboardButton("📁 Upload as Document", callback_data=f"upload_doc_{task_id}")]
+    ])
+
+def rename_buttons(task_id):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("✏️ Rename Now", callback_data=f"rename_now_{task_id}")],
+        [InlineKeyboardButton("⏭️ Skip Rename", callback_data=f"rename_skip_{task_id}")]
+    ])
+
 def format_time(seconds):  
     """Format seconds to minutes and seconds"""  
     minutes = seconds // 60  
@@ -163,14 +198,19 @@ async def restart_command(client, message: Message):
           
         await asyncio.sleep(1)  
           
-        for user_id, task in list(user_tasks.items()):  
-            filepath = task.get('filepath')  
-            if filepath:  
-                try:  
-                    downloader.cleanup(filepath)  
-                except:  
-                    pass  
+        for tasks in list(user_tasks.values()):  
+            for task in tasks.values():
+                filepath = task.get('filepath')  
+                if filepath:  
+                    try:  
+                        downloader.cleanup(filepath)  
+                    except:  
+                        pass  
         user_tasks.clear()  
+        
+        # Flush resume data, DHT state and strategy stats before the new process starts
+        await scheduler.stop()
+        await downloader.close()
           
         subprocess.Popen([sys.executable] + sys.argv)  
         sys.exit(0)  
@@ -412,22 +452,63 @@ async def handle_upload_type(client, callback: CallbackQuery):
     data = callback.data  
     user_id = callback.from_user.id  
       
-    if user_id not in user_tasks:  
+    _, upload_type, task_id = data.split('_', 2)
+    task = user_tasks.get(user_id, {}).get(task_id)
+    if not task:  
         await callback.answer("⚠️ Task expired! Send URL again.", show_alert=True)  
         return  
       
-    task = user_tasks[user_id]  
     filepath = task['filepath']  
-    upload_type = data.split('_')[1]  
+    cached = task.get('cached', {}).get(upload_type)
+    
+    if not filepath and not cached:
+        await callback.answer("⚠️ Task expired! Send URL again.", show_alert=True)
+        return
+    
+    if task.get('uploading'):
+        await callback.answer("⏳ Already uploading!", show_alert=False)
+        return
+    task['uploading'] = True
+    
+    # Resending a cached file_id is instant, only real uploads wait for a worker
+    if cached:
+        await upload_file(client, callback, task, upload_type)
+        return
+    
+    # Uploads stop themselves from the progress callback, cancelling the
+    # task mid-request would leave Pyrogram's upload workers hanging
+    token = task['upload_token'] = CancelToken()
+    try:
+        scheduler.submit(
+            user_id, 'upload',
+            lambda: upload_file(client, callback, task, upload_type, token),
+            on_position=lambda position: show_queue_position(callback.message, position, "upload"),
+            token=token,
+            interrupt=False
+        )
+    except QueueFull as e:
+        task['uploading'] = False
+        await callback.answer(f"🚦 {e}", show_alert=True)
+
+async def upload_file(client, callback, task, upload_type, token=None):
+    """Upload a finished download to the chat the request came from"""
+    user_id = callback.from_user.id
+    filepath = task['filepath']
+    cached = task.get('cached', {}).get(upload_type)
       
     await callback.message.edit_text("⬆️ **Uploading to Telegram...**\n\nPlease wait...")  
+    share = upload_bandwidth.register(user_id)
       
     try:  
         settings = user_settings.get(user_id, {})  
         thumbnail = settings.get('thumbnail')  
           
-        filename = os.path.basename(filepath)  
-        filesize = os.path.getsize(filepath) if os.path.isfile(filepath) else 0  
+        if cached:
+            filename = cached.get('file_name') or 'file'
+            filesize = cached.get('file_size') or 0
+        else:
+            filename = os.path.basename(filepath)  
+            filesize = os.path.getsize(filepath) if os.path.isfile(filepath) else 0  
           
         caption = settings.get('caption',   
             f"📁 **{filename}**\n\n"  
@@ -436,71 +517,39 @@ async def handle_upload_type(client, callback: CallbackQuery):
         )  
           
         progress = Progress(client, callback.message)  
+        upload_progress = make_upload_progress(client, share, token, progress.progress_callback)
           
-        if upload_type == 'doc':  
-            await client.send_document(  
-                chat_id=callback.message.chat.id,  
-                document=filepath,  
-                caption=caption,  
-                thumb=thumbnail,  
-                progress=progress.progress_callback,  
-                progress_args=("Uploading",)  
-            )  
-        else:  
-            ext = get_file_extension(filepath).lower()  
-            image_exts = ['jpg', 'jpeg', 'png', 'gif', 'bmp', 'webp', 'tiff']  
-              
-            if ext in image_exts:  
-                await client.send_photo(  
-                    chat_id=callback.message.chat.id,  
-                    photo=filepath,  
-                    caption=caption,  
-                    progress=progress.progress_callback,  
-                    progress_args=("Uploading",)  
-                )  
-            elif is_video_file(filepath):  
-                duration = width = height = 0  
-                try:  
-                    result = subprocess.run(  
-                        ['ffprobe', '-v', 'error', '-show_entries',  
-                         'format=duration:stream=width,height', '-of',  
-                         'default=noprint_wrappers=1', filepath],  
-                        capture_output=True, text=True, timeout=10  
-                    )  
-                    for line in result.stdout.split('\n'):  
-                        if 'duration=' in line:  
-                            duration = int(float(line.split('=')[1]))  
-                        elif 'width=' in line:  
-                            width = int(line.split('=')[1])  
-                        elif 'height=' in line:  
-                            height = int(line.split('=')[1])  
-                except:  
-                    pass  
-                  
-                await client.send_video(  
-                    chat_id=callback.message.chat.id,  
-                    video=filepath,  
-                    caption=caption,  
-                    thumb=thumbnail,  
-                    duration=duration,  
-                    width=width,  
-                    height=height,  
-                    supports_streaming=True,  
-                    progress=progress.progress_callback,  
-                    progress_args=("Uploading",)  
-                )  
-            else:  
-                await client.send_document(  
-                    chat_id=callback.message.chat.id,  
-                    document=filepath,  
-                    caption=caption,  
-                    thumb=thumbnail,  
-                    progress=progress.progress_callback,  
-                    progress_args=("Uploading",)  
-                )  
+        if cached:
+            # Same content was uploaded before - resend by file_id, no transfer
+            await client.send_cached_media(
+                chat_id=callback.message.chat.id,
+                file_id=cached['file_id'],
+                caption=caption
+            )
+            await db.record_cache_hit(task['cache_key'], upload_type)
+        else:
+            sent = await send_file(client, callback.message.chat.id, filepath, upload_type, caption, thumbnail, upload_progress)
+        
+        if token is not None and token.cancelled:
+            await callback.message.edit_text("🛑 **Upload cancelled!**")
+            return
+        
+        # Custom thumbnails and renames are personal, keep them out of the shared cache
+        if not cached and task.get('cache_key') and not thumbnail and not task.get('renamed'):
+            media = get_sent_media(sent)
+            if media:
+                try:
+                    await db.cache_file(
+                        task['cache_key'], upload_type, media.file_id,
+                        fingerprint=task.get('fingerprint'),
+                        file_name=filename,
+                        file_size=filesize
+                    )
+                except Exception as e:
+                    print(f"File cache error: {e}")
           
         await db.update_stats(user_id, upload=True)  
-        await db.log_action(user_id, "upload", filepath)  
+        await db.log_action(user_id, "upload", filepath or task['url'])  
           
         try:  
             await callback.message.delete()  
@@ -541,9 +590,124 @@ async def handle_upload_type(client, callback: CallbackQuery):
         print(f"Upload error for user {user_id}: {error_msg}")  
       
     finally:  
-        downloader.cleanup(filepath)  
-        if user_id in user_tasks:  
-            del user_tasks[user_id]  
+        share.close()
+        if filepath:
+            downloader.cleanup(filepath)  
+        pop_user_task(user_id, task['id'])
+
+def make_upload_progress(client, share, token=None, callback=None):
+    """Pyrogram progress callback that paces the upload and stops it on cancel"""
+    throttled_progress = upload_bandwidth.progress_throttle(share, callback)
+    
+    async def upload_progress(current, total, *args):
+        # Pyrogram calls this after every part, raising here ends the upload
+        if token is not None and token.cancelled:
+            client.stop_transmission()
+        await throttled_progress(current, total, *args)
+    
+    return upload_progress
+
+async def send_file(client, chat_id, filepath, upload_type, caption, thumbnail=None, progress=None):
+    """Send a local file - as a document, or for 'original' as photo/video when it is one"""
+    if upload_type == 'doc':  
+        return await client.send_document(  
+            chat_id=chat_id,  
+            document=filepath,  
+            caption=caption,  
+            thumb=thumbnail,  
+            progress=progress,  
+            progress_args=("Uploading",)  
+        )  
+    else:  
+        ext = get_file_extension(filepath).lower()  
+        image_exts = ['jpg', 'jpeg', 'png', 'gif', 'bmp', 'webp', 'tiff']  
+          
+        if ext in image_exts:  
+            return await client.send_photo(  
+                chat_id=chat_id,  
+                photo=filepath,  
+                caption=caption,  
+                progress=progress,  
+                progress_args=("Uploading",)  
+            )  
+        elif is_video_file(filepath):  
+            duration = width = height = 0  
+            try:  
+                result = subprocess.run(  
+                    ['ffprobe', '-v', 'error', '-show_entries',  
+                     'format=duration:stream=width,height', '-of',  
+                     'default=noprint_wrappers=1', filepath],  
+                    capture_output=True, text=True, timeout=10  
+                )  
+                for line in result.stdout.split('\n'):  
+                    if 'duration=' in line:  
+                        duration = int(float(line.split('=')[1]))  
+                    elif 'width=' in line:  
+                        width = int(line.split('=')[1])  
+                    elif 'height=' in line:  
+                        height = int(line.split('=')[1])  
+            except:  
+                pass  
+              
+            return await client.send_video(  
+                chat_id=chat_id,  
+                video=filepath,  
+                caption=caption,  
+                thumb=thumbnail,  
+                duration=duration,  
+                width=width,  
+                height=height,  
+                supports_streaming=True,  
+                progress=progress,  
+                progress_args=("Uploading",)  
+            )  
+        else:  
+            return await client.send_document(  
+                chat_id=chat_id,  
+                document=filepath,  
+                caption=caption,  
+                thumb=thumbnail,  
+                progress=progress,  
+                progress_args=("Uploading",)  
+            )
+
+async def show_queue_position(message, position, action="download"):
+    """Tell the user where their job is in the queue"""
+    try:
+        await message.edit_text(
+            f"⏳ **Queued for {action}...**\n\n"
+            f"📊 **Position:** {position}\n\n"
+            f"It will start automatically, no need to resend."
+        )
+    except Exception:
+        pass
+
+def get_sent_media(message):
+    """Get the uploaded media object of a sent message"""
+    if not message:
+        return None
+    for attr in ('video', 'document', 'photo', 'audio', 'animation'):
+        media = getattr(message, attr, None)
+        if media:
+            return media
+    return None
+
+# Cached file offered but user wants a fresh copy
+@app.on_callback_query(filters.regex("^cache_refresh_"))
+async def cache_refresh_callback(client, callback: CallbackQuery):
+    user_id = callback.from_user.id
+    task = pop_user_task(user_id, callback.data.rsplit('_', 1)[1])
+    
+    if not task or not task.get('message'):
+        await callback.answer("⚠️ Task expired! Send URL again.", show_alert=True)
+        return
+    
+    await callback.answer()
+    try:
+        await callback.message.delete()
+    except:
+        pass
+    await process_download(client, task['message'], task['url'], use_cache=False)
 
 async def cooldown_refresh_message(client, message, user_id):  
     """Refresh the cooldown message every 10 seconds"""  
@@ -596,13 +760,21 @@ async def handle_rename_callback(client, callback: CallbackQuery):
     data = callback.data  
     user_id = callback.from_user.id  
       
-    if user_id not in user_tasks:  
+    _, action, task_id = data.split('_', 2)
+    task = user_tasks.get(user_id, {}).get(task_id)
+    if not task:  
         await callback.answer("⚠️ Task expired!", show_alert=True)  
         return  
       
-    if data == "rename_now":  
-        filename = os.path.basename(user_tasks[user_id]['filepath'])  
-        user_tasks[user_id]['waiting_rename'] = True  
+    if action == "now":  
+        if not task.get('filepath'):
+            await callback.answer("⚠️ Cached files can't be renamed, download again first.", show_alert=True)
+            return
+        filename = os.path.basename(task['filepath'])  
+        # The next text message names this file, not another waiting one
+        for other in user_tasks[user_id].values():
+            other['waiting_rename'] = False
+        task['waiting_rename'] = True  
           
         await callback.message.edit_text(  
             f"📝 **Send new name for this file**\n\n"  
@@ -611,18 +783,13 @@ async def handle_rename_callback(client, callback: CallbackQuery):
         )  
         await callback.answer("Type new filename and send", show_alert=False)  
           
-    elif data == "rename_skip":  
-        user_tasks[user_id]['waiting_rename'] = False  
-          
-        keyboard = InlineKeyboardMarkup([  
-            [InlineKeyboardButton("📤 Upload as Original", callback_data="upload_original")],  
-            [InlineKeyboardButton("📁 Upload as Document", callback_data="upload_doc")]  
-        ])  
+    elif action == "skip":  
+        task['waiting_rename'] = False  
           
         await callback.message.edit_text(  
             "**Choose upload type:**\n\n"  
             "How do you want to upload this file?",  
-            reply_markup=keyboard  
+            reply_markup=upload_buttons(task_id)  
         )  
         await callback.answer()  
 
@@ -632,31 +799,27 @@ async def handle_text_input(client, message: Message):
     user_id = message.from_user.id  
     add_reaction(message)  
       
-    if user_id in user_tasks and user_tasks[user_id].get('waiting_rename'):  
+    task = next((t for t in user_tasks.get(user_id, {}).values() if t.get('waiting_rename')), None)
+    if task:  
         new_name = sanitize_filename(message.text.strip())  
-        filepath = user_tasks[user_id]['filepath']  
+        filepath = task['filepath']  
         new_path = os.path.join(os.path.dirname(filepath), new_name)  
           
         try:  
             if os.path.exists(filepath):  
-                os.rename(filepath, new_path)  
-                user_tasks[user_id]['filepath'] = new_path  
-                user_tasks[user_id]['waiting_rename'] = False  
-                  
-                keyboard = InlineKeyboardMarkup([  
-                    [InlineKeyboardButton("📤 Upload as Original", callback_data="upload_original")],  
-                    [InlineKeyboardButton("📁 Upload as Document", callback_data="upload_doc")]  
-                ])  
+                downloader.rename(filepath, new_path)
+                task['filepath'] = new_path  
+                task['waiting_rename'] = False  
+                task['renamed'] = True
                   
                 await message.reply_text(  
                     f"✅ **Renamed to:** `{new_name}`\n\n"  
                     f"**Choose upload type:**",  
-                    reply_markup=keyboard  
+                    reply_markup=upload_buttons(task['id'])  
                 )  
             else:  
                 await message.reply_text("❌ **Error:** File not found!")  
-                if user_id in user_tasks:  
-                    del user_tasks[user_id]  
+                pop_user_task(user_id, task['id'])
         except Exception as e:  
             await message.reply_text(f"❌ **Rename failed:** {str(e)}")  
         return  
@@ -753,12 +916,12 @@ async def handle_direct_file_upload(client, message: Message):
         filename = os.path.basename(filepath)  
         filesize = os.path.getsize(filepath) if os.path.isfile(filepath) else 0  
           
-        user_tasks[user_id] = {  
+        task_id = add_user_task(user_id, {  
             'filepath': filepath,  
             'url': 'direct_upload',  
             'waiting_rename': False,  
             'is_direct_upload': True  
-        }  
+        })  
           
         text = (  
             f"✅ **File Received!**\n\n"  
@@ -767,12 +930,7 @@ async def handle_direct_file_upload(client, message: Message):
             f"Do you want to rename this file before re-uploading?"  
         )  
           
-        keyboard = InlineKeyboardMarkup([  
-            [InlineKeyboardButton("✏️ Rename Now", callback_data="rename_now")],  
-            [InlineKeyboardButton("⏭️ Skip Rename", callback_data="rename_skip")]  
-        ])  
-          
-        await message.reply_text(text, reply_markup=keyboard)  
+        await message.reply_text(text, reply_markup=rename_buttons(task_id))  
           
         await db.update_stats(user_id, download=True)  
         await db.log_action(user_id, "direct_upload", filename)  
@@ -797,7 +955,7 @@ async def handle_direct_file_upload(client, message: Message):
         await db.log_action(user_id, "error", str(e))  
 
 # Download processing function  
-async def process_download(client, message: Message, url):  
+async def process_download(client, message: Message, url, use_cache=True):  
     user_id = message.from_user.id  
       
     await db.add_user(user_id, message.from_user.username, message.from_user.first_name)  
@@ -807,11 +965,108 @@ async def process_download(client, message: Message, url):
         "Starting download..."  
     )  
       
+    cache_key = downloader.cache_key(url)
+    token = CancelToken()
+    checked = asyncio.get_running_loop().create_future()  # (go ahead, fingerprint) once probed
+    
+    # Queue right away, the probe below may take a while and the job waits for it
+    try:
+        job = scheduler.submit(
+            user_id, downloader.job_kind(url),
+            lambda: run_download(client, message, status_msg, url, cache_key, checked, token),
+            on_position=lambda position: show_queue_position(status_msg, position),
+            token=token
+        )
+    except QueueFull as e:
+        await status_msg.edit_text(f"🚦 **Queue is full!**\n\n{e}")
+        return
+    
+    def drop():
+        scheduler.withdraw(job)
+        if not checked.done():
+            checked.set_result((False, None))
+    
+    try:  
+        fingerprint = await downloader.probe(url)
+        if token.cancelled:
+            drop()
+            return
+        
+        # Users with their own thumbnail expect it on the file, so they always get a fresh upload
+        if use_cache and cache_key and not user_settings.get(user_id, {}).get('thumbnail'):
+            cached = await db.get_cached_files(cache_key, fingerprint)
+            if cached:
+                drop()
+                await offer_cached_file(status_msg, user_id, message, url, cache_key, fingerprint, cached)
+                return
+        
+        # Jobs that can't fit give their queue slot back before they start
+        rejected = await downloader.preflight(url, fingerprint)
+        if rejected:
+            drop()
+            await status_msg.edit_text(f"🚫 **Can't download this!**\n\n{rejected}")
+            return
+        
+        checked.set_result((True, fingerprint))
+              
+    except Exception as e:  
+        drop()
+        await status_msg.edit_text(  
+            f"❌ **Error:** {str(e)[:300]}\n\n"  
+            f"Something went wrong. Please try again."  
+        )  
+        await db.log_action(user_id, "error", str(e))  
+    finally:
+        # Never leave the job waiting on checks that won't finish
+        if not checked.done():
+            drop()
+
+async def run_download(client, message: Message, status_msg, url, cache_key=None, checked=None, token=None):
+    """Download worker job - fetch the file and offer the upload options"""
+    go, fingerprint = await checked if checked is not None else (True, None)
+    if not go:
+        return
+    user_id = message.from_user.id
+    is_torrent = downloader.job_kind(url) == 'torrent'
+    streamed = []
+    partial = False  # only some files of the torrent were picked
+    
+    async def select_files(info):
+        nonlocal partial
+        chosen = await pick_torrent_files(status_msg, user_id, info)
+        partial = bool(chosen) and len(chosen) < len(wanted_files(info))
+        return chosen
+    
+    async def upload_torrent_file(path):
+        """Send one finished file of a multi-file torrent while the rest downloads"""
+        name = os.path.basename(path)
+        size = os.path.getsize(path)
+        settings = user_settings.get(user_id, {})
+        caption = settings.get('caption',
+            f"📁 **{name}**\n\n"
+            f"💾 **Size:** {humanbytes(size)}\n"
+            f"⚡ **Powered by:** {Config.DEVELOPER}"
+        )
+        share = upload_bandwidth.register(user_id)
+        try:
+            sent = await send_file(
+                client, message.chat.id, path, 'original', caption,
+                settings.get('thumbnail'), make_upload_progress(client, share, token)
+            )
+        finally:
+            share.close()
+        if sent:
+            streamed.append(name)
+    
     try:  
         progress = Progress(client, status_msg)  
         filepath, error = await downloader.download(  
             url,   
-            progress_callback=progress.progress_callback  
+            progress_callback=progress.progress_callback,
+            user_id=user_id,
+            cancel_token=token,
+            on_file_complete=upload_torrent_file if is_torrent else None,
+            select_files=select_files if is_torrent else None
         )  
           
         if error:  
@@ -824,12 +1079,27 @@ async def process_download(client, message: Message, url):
           
         await db.update_stats(user_id, download=True)  
         await db.log_action(user_id, "download", str(url) if isinstance(url, str) else "torrent")  
+        
+        # Multi-file torrent - every file was already sent as it finished
+        if streamed:
+            downloader.cleanup(filepath)
+            await db.update_stats(user_id, upload=True)
+            user_cooldowns[user_id] = time.time()
+            await status_msg.edit_text(
+                f"✅ **Torrent Complete!**\n\n"
+                f"📤 **Uploaded:** {len(streamed)} files\n"
+                f"⏳ You can send new task after **{format_time(get_remaining_time(user_id))}**"
+            )
+            return
           
-        user_tasks[user_id] = {  
+        task_id = add_user_task(user_id, {  
             'filepath': filepath,  
             'url': url if isinstance(url, str) else 'torrent',  
-            'waiting_rename': False  
-        }  
+            'waiting_rename': False,
+            # The cache is keyed on the whole torrent, a pick isn't what the next sender gets
+            'cache_key': None if partial else cache_key,
+            'fingerprint': fingerprint
+        })  
           
         filename = os.path.basename(filepath)  
         filesize = os.path.getsize(filepath) if os.path.isfile(filepath) else 0  
@@ -841,12 +1111,7 @@ async def process_download(client, message: Message, url):
             f"Do you want to rename this file?"  
         )  
           
-        keyboard = InlineKeyboardMarkup([  
-            [InlineKeyboardButton("✏️ Rename Now", callback_data="rename_now")],  
-            [InlineKeyboardButton("⏭️ Skip Rename", callback_data="rename_skip")]  
-        ])  
-          
-        await status_msg.edit_text(text, reply_markup=keyboard)  
+        await status_msg.edit_text(text, reply_markup=rename_buttons(task_id))  
           
         try:  
             await client.send_message(  
@@ -859,7 +1124,14 @@ async def process_download(client, message: Message, url):
             )  
         except:  
             pass  
-              
+    
+    except asyncio.CancelledError:
+        if token is not None and token.cancelled:
+            try:
+                await status_msg.edit_text("🛑 **Download cancelled!**")
+            except Exception:
+                pass
+        raise
     except Exception as e:  
         await status_msg.edit_text(  
             f"❌ **Error:** {str(e)[:300]}\n\n"  
@@ -867,6 +1139,144 @@ async def process_download(client, message: Message, url):
         )  
         await db.log_action(user_id, "error", str(e))  
 
+async def pick_torrent_files(status_msg, user_id, info):
+    """Let the user choose the files of a multi-file torrent, None if cancelled or timed out"""
+    files = info.files()
+    picker = {
+        'user_id': user_id,
+        'message': status_msg,
+        'files': [(i, os.path.basename(files.file_path(i)), files.file_size(i)) for i in wanted_files(info)],
+        'selected': set(),
+        'page': 0,
+        'future': asyncio.get_running_loop().create_future()
+    }
+    key = (status_msg.chat.id, status_msg.id)
+    file_pickers[key] = picker
+    
+    try:
+        await render_file_picker(picker)
+        return await asyncio.wait_for(picker['future'], timeout=PICKER_TIMEOUT)
+    except asyncio.TimeoutError:
+        return None
+    finally:
+        if file_pickers.get(key) is picker:
+            del file_pickers[key]
+
+async def render_file_picker(picker):
+    """Show one page of the torrent file list as toggle buttons"""
+    files = picker['files']
+    pages = max(1, (len(files) + PICKER_PAGE_SIZE - 1) // PICKER_PAGE_SIZE)
+    page = min(picker['page'], pages - 1)
+    selected_size = sum(size for i, name, size in files if i in picker['selected'])
+    
+    buttons = []
+    for i, name, size in files[page * PICKER_PAGE_SIZE:(page + 1) * PICKER_PAGE_SIZE]:
+        mark = "✅" if i in picker['selected'] else "⬜"
+        label = name if len(name) <= 40 else name[:37] + "..."
+        buttons.append([InlineKeyboardButton(f"{mark} {label} ({humanbytes(size)})", callback_data=f"pick_file_{i}")])
+    
+    if pages > 1:
+        buttons.append([
+            InlineKeyboardButton("◀️", callback_data=f"pick_page_{(page - 1) % pages}"),
+            InlineKeyboardButton(f"{page + 1}/{pages}", callback_data="pick_noop"),
+            InlineKeyboardButton("▶️", callback_data=f"pick_page_{(page + 1) % pages}")
+        ])
+    buttons.append([
+        InlineKeyboardButton("☑️ Select All", callback_data="pick_all"),
+        InlineKeyboardButton("🔲 Clear", callback_data="pick_none")
+    ])
+    buttons.append([
+        InlineKeyboardButton("⬇️ Download Selected", callback_data="pick_done"),
+        InlineKeyboardButton("❌ Cancel", callback_data="pick_cancel")
+    ])
+    
+    await picker['message'].edit_text(
+        f"🧲 **Choose files to download**\n\n"
+        f"📂 **Files:** {len(files)}\n"
+        f"✅ **Selected:** {len(picker['selected'])} ({humanbytes(selected_size)})\n"
+        f"💾 **Limit:** {humanbytes(Config.MAX_FILE_SIZE)}",
+        reply_markup=InlineKeyboardMarkup(buttons)
+    )
+
+# Torrent file picker buttons
+@app.on_callback_query(filters.regex("^pick_"))
+async def handle_file_picker(client, callback: CallbackQuery):
+    data = callback.data
+    picker = file_pickers.get((callback.message.chat.id, callback.message.id))
+    
+    if picker is None or picker['future'].done() or callback.from_user.id != picker['user_id']:
+        await callback.answer("⚠️ File selection expired!", show_alert=True)
+        return
+    
+    if data == "pick_noop":
+        await callback.answer()
+        return
+    
+    if data == "pick_cancel":
+        picker['future'].set_result(None)
+        await callback.answer("Cancelled")
+        return
+    
+    if data == "pick_done":
+        selected_size = sum(size for i, name, size in picker['files'] if i in picker['selected'])
+        if not picker['selected']:
+            await callback.answer("Select at least one file!", show_alert=True)
+        elif selected_size > Config.MAX_FILE_SIZE:
+            await callback.answer(
+                f"Selection is {humanbytes(selected_size)}, the limit is {humanbytes(Config.MAX_FILE_SIZE)}!",
+                show_alert=True
+            )
+        else:
+            picker['future'].set_result(sorted(picker['selected']))
+            await callback.answer()
+            await callback.message.edit_text("🧲 **Starting torrent download...**")
+        return
+    
+    if data == "pick_all":
+        picker['selected'] = {i for i, name, size in picker['files']}
+    elif data == "pick_none":
+        picker['selected'].clear()
+    elif data.startswith("pick_page_"):
+        picker['page'] = int(data.split('_')[2])
+    elif data.startswith("pick_file_"):
+        index = int(data.split('_')[2])
+        picker['selected'].symmetric_difference_update({index})
+    
+    await callback.answer()
+    try:
+        await render_file_picker(picker)
+    except Exception:
+        pass
+
+async def offer_cached_file(status_msg, user_id, message, url, cache_key, fingerprint, cached):
+    """Offer to resend an already uploaded copy of this URL"""
+    entry = next(iter(cached.values()))
+    
+    task_id = add_user_task(user_id, {
+        'filepath': None,
+        'url': url,
+        'message': message,
+        'waiting_rename': False,
+        'cached': cached,
+        'cache_key': cache_key,
+        'fingerprint': fingerprint
+    })
+    
+    buttons = []
+    if 'original' in cached:
+        buttons.append([InlineKeyboardButton("⚡ Send as Original", callback_data=f"upload_original_{task_id}")])
+    if 'doc' in cached:
+        buttons.append([InlineKeyboardButton("⚡ Send as Document", callback_data=f"upload_doc_{task_id}")])
+    buttons.append([InlineKeyboardButton("🔄 Download Again", callback_data=f"cache_refresh_{task_id}")])
+    
+    await status_msg.edit_text(
+        f"⚡ **Found in cache!**\n\n"
+        f"📁 **File:** `{entry.get('file_name')}`\n"
+        f"💾 **Size:** {humanbytes(entry.get('file_size') or 0)}\n\n"
+        f"This file can be sent instantly without downloading.",
+        reply_markup=InlineKeyboardMarkup(buttons)
+    )
+
 # Settings commands  
 @app.on_message(filters.command("setname") & filters.private)  
 async def setname_command(client, message: Message):  
@@ -1009,6 +1419,8 @@ async def total_command(client, message: Message):
 • Speed: Up to 500 MB/s  
 • Max Size: 4 GB  
 • Cooldown: {COOLDOWN_TIME} seconds ({format_time(COOLDOWN_TIME)})  
+• Queue: {scheduler.queued} waiting, {sum(len(jobs) for jobs in scheduler.running.values())} running
+• Disk: {humanbytes(await downloader.disk.refresh())} used{f" of {humanbytes(Config.DISK_HIGH_WATER)}" if Config.DISK_HIGH_WATER else ""}, {humanbytes(downloader.disk.outstanding)} reserved
 • Status: ✅ Online  
   
 **Developer:** {Config.DEVELOPER}  
@@ -1077,16 +1489,18 @@ async def cancel_command(client, message: Message):
     add_reaction(message)  
       
     user_id = message.from_user.id  
-      
-    if user_id in user_tasks:  
-        task = user_tasks[user_id]  
-        filepath = task.get('filepath')  
-          
-        if filepath:  
-            downloader.cleanup(filepath)  
-          
-        del user_tasks[user_id]  
-          
+    
+    # Stops queued and running downloads/uploads, not just the offer below
+    jobs = scheduler.cancel_user(user_id)
+    tasks = user_tasks.pop(user_id, {})
+    
+    if tasks or jobs:
+        # A running upload releases its file itself once it has stopped
+        uploading = {job.token for job in jobs if job.kind == 'upload' and job.task}
+        for task in tasks.values():
+            if task.get('filepath') and task.get('upload_token') not in uploading:
+                downloader.cleanup(task['filepath'])
+        
         await message.reply_text(  
             "✅ **Task cancelled successfully!**\n\n"  
             "You can send a new URL/magnet link."  
@@ -1117,6 +1531,12 @@ async def ping_command(client, message: Message):
 # Startup message  
 async def startup():  
     """Send startup notification"""  
+    await downloader.start()
+    scheduler.start()
+    removed = downloader.prune_partials()
+    if removed:
+        print(f"🧹 Removed {removed} stale partial download files")
+      
     try:  
         await app.send_message(  
             Config.OWNER_ID,  
@@ -1135,12 +1555,14 @@ async def shutdown():
     """Cleanup on shutdown"""  
     print("🛑 Bot shutting down...")  
       
-    for user_id, task in list(user_tasks.items()):  
-        filepath = task.get('filepath')  
-        if filepath:  
-            downloader.cleanup(filepath)  
+    for tasks in list(user_tasks.values()):  
+        for task in tasks.values():
+            if task.get('filepath'):  
+                downloader.cleanup(task['filepath'])  
       
     user_tasks.clear()  
+    await scheduler.stop()
+    await downloader.close()
       
     try:  
         await app.send_message(  
@@ -0,0 +1,177 @@
+import os
+import json
+import time
+import shutil
+import asyncio
+import hashlib
+from collections import OrderedDict
+
+def hash_file(filepath, block_size=4 * 1024 * 1024):
+    """SHA-256 of a file - blocking, run it in an executor"""
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+class DownloadCache:
+    """Content-addressed store of finished downloads with LRU eviction"""
+
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = cache_dir
+        self.objects_dir = os.path.join(cache_dir, 'objects')
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        self.max_size = max_size
+        self.entries = {}  # url key -> {'hash', 'name', 'etag', 'last_modified'}
+        self.objects = {}  # sha256 -> {'size', 'last_used'}
+
+        if self.enabled:
+            os.makedirs(self.objects_dir, exist_ok=True)
+            self._load()
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    @property
+    def total_size(self):
+        return sum(obj['size'] for obj in self.objects.values())
+
+    def _object_path(self, digest):
+        return os.path.join(self.objects_dir, digest)
+
+    def _load(self):
+        try:
+            with open(self.index_path, 'r') as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return
+
+        self.objects = {
+            digest: obj for digest, obj in index.get('objects', {}).items()
+            if os.path.isfile(self._object_path(digest))
+        }
+        self.entries = {
+            key: entry for key, entry in index.get('entries', {}).items()
+            if entry.get('hash') in self.objects
+        }
+
+    def _save(self):
+        tmp_path = self.index_path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump({'entries': self.entries, 'objects': self.objects}, f)
+            os.replace(tmp_path, self.index_path)
+        except OSError as e:
+            print(f"Download cache index error: {e}")
+
+    def lookup(self, url_key):
+        """Get the cache entry for a URL, if any"""
+        if not self.enabled or not url_key:
+            return None
+        return self.entries.get(url_key)
+
+    def conditional_headers(self, entry):
+        """Request headers that let the origin answer 304 if the entry is still fresh"""
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def checkout(self, entry, filepath):
+        """Materialize a cached object at filepath"""
+        source = self._object_path(entry['hash'])
+        try:
+            os.link(source, filepath)
+        except FileExistsError:
+            os.remove(filepath)
+            os.link(source, filepath)
+        except OSError:
+            shutil.copy2(source, filepath)
+
+        self.objects[entry['hash']]['last_used'] = time.time()
+        self._save()
+        return filepath
+
+    def forget(self, url_key):
+        """Drop a URL whose origin content changed"""
+        if self.entries.pop(url_key, None):
+            self._save()
+
+    async def store(self, url_key, filepath, etag='', last_modified=''):
+        """Add a finished download to the cache if it has a validator to revalidate it with"""
+        if not self.enabled or not url_key or not (etag or last_modified):
+            return
+
+        try:
+            size = os.path.getsize(filepath)
+            if size > self.max_size:
+                return
+
+            loop = asyncio.get_running_loop()
+            digest = await loop.run_in_executor(None, hash_file, filepath)
+
+            target = self._object_path(digest)
+            if not os.path.exists(target):
+                try:
+                    os.link(filepath, target)
+                except OSError:
+                    shutil.copy2(filepath, target)
+        except OSError as e:
+            print(f"Download cache store error: {e}")
+            return
+
+        self.objects[digest] = {'size': size, 'last_used': time.time()}
+        self.entries[url_key] = {
+            'hash': digest,
+            'name': os.path.basename(filepath),
+            'etag': etag,
+            'last_modified': last_modified
+        }
+        self.evict()
+        self._save()
+
+    def evict(self):
+        """Remove least recently used objects until the cache fits its budget"""
+        total = self.total_size
+        for digest, obj in sorted(self.objects.items(), key=lambda item: item[1]['last_used']):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(self._object_path(digest))
+            except OSError:
+                pass
+            total -= obj['size']
+            del self.objects[digest]
+            self.entries = {k: e for k, e in self.entries.items() if e['hash'] != digest}
+
+class InfoCache:
+    """In-memory LRU cache of extractor results that expire after `ttl` seconds"""
+
+    def __init__(self, ttl, max_entries=1000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # key -> (expires_at, value)
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, key, value):
+        if self.ttl <= 0:
+            return
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def forget(self, key):
+        self.entries.pop(key, None)
@@ -29,15 +29,111 @@ class Config:
     
     # Download/Upload settings
     MAX_FILE_SIZE = 4 * 1024 * 1024 * 1024  # 4 GB
-    SPEED_LIMIT = 500 * 1024 * 1024  # 500 MB/s (SUPER FAST!)
+    MIN_FREE_SPACE = int(os.environ.get("MIN_FREE_SPACE", str(1024 * 1024 * 1024)))  # Disk space downloads always leave free
+    DISK_HIGH_WATER = int(os.environ.get("DISK_HIGH_WATER", "0"))  # Most bytes DOWNLOAD_DIR may use, 0 = no limit
+    DISK_RECHECK_INTERVAL = 10  # Seconds between free space checks of jobs waiting for room
+    SPEED_LIMIT = int(os.environ.get("SPEED_LIMIT", str(500 * 1024 * 1024)))  # 500 MB/s (SUPER FAST!) shared by all downloads, 0 = unlimited
+    UPLOAD_SPEED_LIMIT = int(os.environ.get("UPLOAD_SPEED_LIMIT", str(SPEED_LIMIT)))  # Shared by all Telegram uploads
     CHUNK_SIZE = 2 * 1024 * 1024  # 2 MB chunks for maximum speed
     
+    # Shared HTTP connection pool
+    HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", "200"))  # Total open connections
+    HTTP_POOL_PER_HOST = int(os.environ.get("HTTP_POOL_PER_HOST", "64"))  # Per origin host
+    HTTP_KEEPALIVE = 60  # Seconds an idle connection stays in the pool
+    DNS_CACHE_TTL = 600  # Seconds resolved hosts are cached
+    
+    # Segmented (multi-connection) HTTP downloads
+    MAX_CONNECTIONS = int(os.environ.get("MAX_CONNECTIONS", "16"))  # Upper bound of parallel ranges per file
+    INITIAL_CONNECTIONS = 4  # Connections opened before throughput is measured
+    MIN_SEGMENT_SIZE = 4 * 1024 * 1024  # Never split a range below 4 MB
+    SEGMENT_RETRIES = 5  # Retries per range before the download fails
+    WRITE_BUFFER_SIZE = 4 * 1024 * 1024  # Bytes batched before each disk write
+    WRITE_QUEUE_DEPTH = 4  # Buffers queued to the writer thread before downloads wait
+    PARTIAL_MAX_AGE = int(os.environ.get("PARTIAL_MAX_AGE", str(24 * 3600)))  # Keep resumable .part files for 24h
+    
     # Download directory
     DOWNLOAD_DIR = "downloads"
     
+    # Local content-addressed cache of finished downloads (0 disables it)
+    DOWNLOAD_CACHE_SIZE = int(os.environ.get("DOWNLOAD_CACHE_SIZE", "0"))  # Disk budget in bytes
+    
+    # Telegram file_id cache for repeat URLs
+    FILE_CACHE_TTL = int(os.environ.get("FILE_CACHE_TTL", str(30 * 24 * 3600)))  # 30 days
+    
+    # Job queue - workers per job type and queue bounds
+    HTTP_WORKERS = int(os.environ.get("HTTP_WORKERS", "4"))
+    YTDLP_WORKERS = int(os.environ.get("YTDLP_WORKERS", "2"))
+    TORRENT_WORKERS = int(os.environ.get("TORRENT_WORKERS", "2"))
+    UPLOAD_WORKERS = int(os.environ.get("UPLOAD_WORKERS", "3"))
+    MAX_QUEUE_SIZE = int(os.environ.get("MAX_QUEUE_SIZE", "100"))  # Waiting jobs across all users
+    MAX_USER_JOBS = 2  # Waiting jobs per user
+    
+    # yt-dlp worker processes
+    YTDLP_PROCESSES = int(os.environ.get("YTDLP_PROCESSES", str(YTDLP_WORKERS)))
+    YTDLP_MAX_JOBS_PER_PROCESS = 50  # Recycle a worker after this many jobs
+    YTDLP_CANCEL_GRACE = 5  # Seconds a cancelled job gets before its worker is killed
+    YTDLP_PROGRESS_INTERVAL = 0.5  # Seconds between progress messages from a worker
+    TIKTOK_HEDGE_DELAY = 2  # Seconds the direct TikTok sources get before yt-dlp joins the race
+    YTDLP_INFO_TTL = int(os.environ.get("YTDLP_INFO_TTL", "1800"))  # Seconds probed video info is reused, 0 disables
+    
+    # Adaptive ordering of alternative download strategies per site
+    STRATEGY_WINDOW = 50  # Outcomes remembered per site and strategy
+    STRATEGY_MAX_AGE = 7 * 24 * 3600  # Forget outcomes older than a week
+    STRATEGY_MIN_SAMPLES = 5  # Attempts before a strategy can be written off
+    STRATEGY_MIN_SUCCESS = 0.1  # Success rate below which it is skipped
+    STRATEGY_EXPLORE = 0.05  # Chance a skipped strategy is tried anyway
+    STRATEGY_SAVE_INTERVAL = 60  # Seconds between writes of the stats file
+    
+    # Routing of links to torrent, yt-dlp or plain HTTP downloads
+    ROUTE_CACHE_SIZE = 4096  # Hosts whose routing decision is remembered
+    ROUTE_PROBE = os.environ.get("ROUTE_PROBE", "true").lower() == "true"  # Send links to web pages to yt-dlp
+    ROUTE_LEARN_TTL = int(os.environ.get("ROUTE_LEARN_TTL", "3600"))  # Seconds a route learned from a content type holds, 0 disables
+    
     # Torrent settings
     TORRENT_DOWNLOAD_PATH = "downloads/torrents"
+    TORRENT_STATE_PATH = "downloads/torrent_state"  # DHT state, resume data and cached metadata
+    TORRENT_SAVE_INTERVAL = 60  # Seconds between resume data checkpoints
+    TORRENT_UPDATE_INTERVAL = 1  # Seconds between batched status updates of changed torrents
     TORRENT_SEED_TIME = 0  # Don't seed after download
+    TORRENT_PROFILE = os.environ.get("TORRENT_PROFILE", "server")  # Key of TORRENT_PROFILES
+    
+    # libtorrent settings per performance profile, applied on top of its defaults
+    TORRENT_PROFILES = {
+        # Lots of bandwidth and cores - deep request queues, big send
+        # buffers and enough disk/hash threads to keep up with them
+        "server": {
+            'connections_limit': 800,
+            'aio_threads': max(4, min(32, 2 * (os.cpu_count() or 2))),
+            'hashing_threads': max(2, min(16, os.cpu_count() or 2)),
+            'max_queued_disk_bytes': 64 * 1024 * 1024,
+            'send_buffer_watermark': 8 * 1024 * 1024,
+            'send_buffer_low_watermark': 1024 * 1024,
+            'send_buffer_watermark_factor': 150,
+            'max_out_request_queue': 1500,
+            'max_allowed_in_request_queue': 2000,
+            'request_queue_time': 5,
+            'choking_algorithm': 2,  # rate_based_choker
+            'seed_choking_algorithm': 1,  # fastest_upload
+            'mixed_mode_algorithm': 0,  # prefer_tcp
+            'suggest_mode': 1,  # suggest_read_cache
+        },
+        # Small containers - few threads, shallow queues and buffers
+        "low_memory": {
+            'connections_limit': 100,
+            'aio_threads': 2,
+            'hashing_threads': 1,
+            'max_queued_disk_bytes': 1024 * 1024,
+            'send_buffer_watermark': 128 * 1024,
+            'send_buffer_low_watermark': 16 * 1024,
+            'max_out_request_queue': 200,
+            'max_allowed_in_request_queue': 250,
+            'checking_mem_usage': 2,
+            'max_peerlist_size': 1000,
+            'max_paused_peerlist_size': 500,
+        },
+        # libtorrent's own desktop-client defaults
+        "default": {},
+    }
     
     # Welcome message
     START_MESSAGE = """ʜᴇʏ {name}**, 
@@ -1,5 +1,5 @@
 from motor.motor_asyncio import AsyncIOMotorClient
-from datetime import datetime
+from datetime import datetime, timedelta
 from config import Config
 
 class Database:
@@ -8,6 +8,7 @@ class Database:
         self.db = self.client['telegram_bot']
         self.users = self.db['users']
         self.logs = self.db['logs']
+        self.file_cache = self.db['file_cache']
         
     async def add_user(self, user_id, username=None, first_name=None):
         """Add or update user in database"""
@@ -64,6 +65,58 @@ class Database:
         }
         await self.logs.insert_one(log_data)
         
+    async def get_cached_files(self, url_key, fingerprint=None):
+        """Get cached Telegram files for a URL by upload type, dropping stale ones"""
+        expiry = datetime.now() - timedelta(seconds=Config.FILE_CACHE_TTL)
+        cached = {}
+        
+        async for entry in self.file_cache.find({'url_key': url_key}):
+            stored = entry.get('fingerprint') or {}
+            if entry.get('created', expiry) <= expiry:
+                stale = True
+            elif fingerprint is None:
+                stale = bool(stored)
+            else:
+                stale = any(
+                    stored.get(field) and fingerprint.get(field) and stored[field] != fingerprint[field]
+                    for field in ('etag', 'last_modified', 'size')
+                )
+            
+            if stale:
+                await self.file_cache.delete_one({'_id': entry['_id']})
+            else:
+                cached[entry['upload_type']] = entry
+        
+        return cached
+        
+    async def cache_file(self, url_key, upload_type, file_id, fingerprint=None, file_name=None, file_size=0):
+        """Remember the Telegram file_id of a finished upload"""
+        await self.file_cache.update_one(
+            {'url_key': url_key, 'upload_type': upload_type},
+            {
+                '$set': {
+                    'file_id': file_id,
+                    'fingerprint': fingerprint or {},
+                    'file_name': file_name,
+                    'file_size': file_size,
+                    'created': datetime.now()
+                },
+                '$setOnInsert': {'hits': 0}
+            },
+            upsert=True
+        )
+        
+    async def record_cache_hit(self, url_key, upload_type):
+        """Count a file served from the cache"""
+        await self.file_cache.update_one(
+            {'url_key': url_key, 'upload_type': upload_type},
+            {'$inc': {'hits': 1}}
+        )
+        
+    async def invalidate_cached_files(self, url_key):
+        """Drop all cached files for a URL"""
+        await self.file_cache.delete_many({'url_key': url_key})
+        
     async def get_stats(self):
         """Get overall statistics"""
         total_users = await self.get_total_users()
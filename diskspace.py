@@ -0,0 +1,150 @@
+import os
+import time
+import shutil
+import asyncio
+from config import Config
+from helpers import humanbytes
+
+class DiskSpace:
+    """Reserves room in the download directory for running jobs"""
+
+    def __init__(self, path, min_free, high_water=0):
+        self.path = path
+        self.min_free = min_free
+        self.high_water = high_water
+        self.reservations = {}  # token or finished path -> [reserved bytes, written bytes]
+        self._released = None
+        self._usage = 0
+        self._scanned_at = None
+        self._scan = None
+
+    def usage(self):
+        """Bytes the download directory took at the last scan, starting a new one if it is old"""
+        if self._stale():
+            try:
+                asyncio.get_running_loop()
+            except RuntimeError:
+                self._usage, self._scanned_at = self._walk(), time.monotonic()
+            else:
+                asyncio.ensure_future(self.refresh())
+        return self._usage
+
+    def _stale(self):
+        return self._scanned_at is None or time.monotonic() - self._scanned_at >= Config.DISK_RECHECK_INTERVAL
+
+    async def refresh(self):
+        """Rescan the directory's usage in an executor unless the last scan is recent"""
+        if not self._stale():
+            return self._usage
+        if self._scan is None:
+            self._scan = asyncio.get_running_loop().run_in_executor(None, self._walk)
+        scan = self._scan
+        try:
+            usage = await scan
+        finally:
+            if self._scan is scan:
+                self._scan = None
+        self._usage, self._scanned_at = usage, time.monotonic()
+        return usage
+
+    def _walk(self):
+        """Bytes the download directory takes on disk, hard links counted once"""
+        seen = set()
+        total = 0
+        for root, _, files in os.walk(self.path):
+            for name in files:
+                try:
+                    st = os.lstat(os.path.join(root, name))
+                except OSError:
+                    continue
+                if (st.st_dev, st.st_ino) in seen:
+                    continue
+                seen.add((st.st_dev, st.st_ino))
+                total += getattr(st, 'st_blocks', 0) * 512 or st.st_size
+        return total
+
+    @property
+    def reserved(self):
+        return sum(reserved for reserved, _ in self.reservations.values())
+
+    @property
+    def outstanding(self):
+        """Reserved bytes not written yet"""
+        return sum(max(reserved - written, 0) for reserved, written in self.reservations.values())
+
+    @property
+    def written(self):
+        return sum(written for _, written in self.reservations.values())
+
+    def headroom(self):
+        """Bytes a new reservation can get right now"""
+        room = shutil.disk_usage(self.path).free - self.min_free
+        if self.high_water:
+            room = min(room, self.high_water - self.usage())
+        return max(room - self.outstanding, 0)
+
+    def capacity(self):
+        """The most a single job could ever get, once every other job released its space"""
+        room = shutil.disk_usage(self.path).free - self.min_free + self.written
+        if self.high_water:
+            room = min(room, self.high_water - self.usage() + self.written)
+        return max(room, 0)
+
+    def try_reserve(self, key, size):
+        """Reserve `size` bytes for a job if they fit now; replaces its earlier reservation"""
+        entry = self.reservations.get(key, [0, 0])
+        held = max(entry[0] - entry[1], 0)
+        if max(size - entry[1], 0) - held > self.headroom():
+            return False
+        self.reservations[key] = [size, entry[1]]
+        return True
+
+    async def reserve(self, key, size, on_wait=None):
+        """Reserve `size` bytes for a job once they fit - None, or an error if they never will"""
+        waited = False
+        while True:
+            if self.high_water:
+                await self.refresh()
+            if self.try_reserve(key, size):
+                break
+            if size > self.capacity():
+                return f"Not enough disk space for {humanbytes(size)} ({humanbytes(self.capacity())} available)"
+            if not waited:
+                waited = True
+                if on_wait:
+                    await on_wait()
+            if self._released is None:
+                self._released = asyncio.Event()
+            # Space also frees up outside our control, look again now and then
+            try:
+                await asyncio.wait_for(self._released.wait(), timeout=Config.DISK_RECHECK_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+        return None
+
+    def wrote(self, key, nbytes):
+        """Record how much of its reservation a job has written"""
+        entry = self.reservations.get(key)
+        if entry is not None and nbytes > entry[1]:
+            entry[1] = nbytes
+
+    def bind(self, key, path):
+        """Hand a finished job's reservation over to the file it produced"""
+        entry = self.reservations.pop(key, None)
+        if entry is not None:
+            size = os.path.getsize(path) if os.path.isfile(path) else entry[1]
+            self.reservations[path] = [size, size]
+
+    def move(self, old_path, new_path):
+        entry = self.reservations.pop(old_path, None)
+        if entry is not None:
+            self.reservations[new_path] = entry
+
+    def release(self, key):
+        """Give a job's or file's space back and wake jobs waiting for it"""
+        if self.reservations.pop(key, None) is None:
+            return
+        self._scanned_at = None  # the released file may be gone, count again
+        if self._released is not None:
+            self._released.set()
+            self._released = None
@@ -4,13 +4,27 @@ import asyncio
 import yt_dlp
 import libtorrent as lt
 from config import Config
-from helpers import sanitize_filename
+from helpers import sanitize_filename, normalize_url
+from writer import FileWriter
+from cache import DownloadCache, InfoCache
+from bandwidth import download_bandwidth
+from jobs import CancelToken
+from torrent import TorrentSession, FilePipeline, wanted_files
+from ytdlp_pool import ytdlp_pool, probe_video, download_video
+from manifest import UnsupportedManifest, MasterPlaylist, parse_hls
+from strategies import StrategyStats, site_of
+from diskspace import DiskSpace
+from resolvers import ResolverRegistry, TorrentResolver, ManifestResolver, DomainResolver, ExtractorResolver, VIDEO_DOMAINS, host_matches
+from urllib.parse import urlparse
 import time
 import shutil
 import hashlib
 import re
 import json
 
+# TikTok's domain - short link hosts are subdomains of it; also the site its resolution outcomes are recorded under
+TIKTOK_SITE = 'tiktok.com'
+
 # Auxiliary function for formatting file sizes
 def format_bytes(size):
     """Format bytes into human-readable string (e.g., 1.2 GB)"""
@@ -36,258 +50,927 @@ def truncate_filename(filename, max_length=200):
     
     return name + ext
 
+def estimate_video_size(info):
+    """Expected download size of a probed yt-dlp info dict, 0 if unknown"""
+    if info.get('_type') == 'playlist':
+        return sum(estimate_video_size(entry) for entry in info.get('entries') or [] if entry)
+    
+    size = 0
+    for fmt in info.get('requested_formats') or [info]:
+        size += (fmt.get('filesize') or fmt.get('filesize_approx') or
+                 (fmt.get('tbr') or 0) * 1000 / 8 * (info.get('duration') or 0))
+    return int(size)
+
+async def race(attempts):
+    """Run hedged (delay, coroutine function) attempts concurrently, return the first result"""
+    primaries_failed = asyncio.Event()
+    
+    async def hedged(delay, func):
+        if delay:
+            try:
+                await asyncio.wait_for(primaries_failed.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+        return await func()
+    
+    primaries = set()
+    pending = set()
+    for delay, func in attempts:
+        task = asyncio.create_task(hedged(delay, func))
+        pending.add(task)
+        if not delay:
+            primaries.add(task)
+    
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if not task.cancelled() and task.exception() is None and task.result() is not None:
+                    return task.result()
+            if all(task.done() for task in primaries):
+                primaries_failed.set()
+        return None
+    finally:
+        for task in pending:
+            task.cancel()
+
+class RangeNotSupported(Exception):
+    """Raised when a server ignores byte-range requests"""
+
+class FileTooLarge(Exception):
+    """Raised when a download of unknown size grows past MAX_FILE_SIZE"""
+
+def get_total_size(response):
+    """Get full resource size from Content-Range or Content-Length"""
+    content_range = response.headers.get('content-range', '')
+    if '/' in content_range:
+        total = content_range.rsplit('/', 1)[1].strip()
+        if total.isdigit():
+            return int(total)
+    return int(response.headers.get('content-length', 0))
+
+def supports_ranges(response, total_size):
+    """Check if a response allows splitting the download into byte ranges"""
+    if total_size < 2 * Config.MIN_SEGMENT_SIZE:
+        return False
+    if response.headers.get('content-encoding', 'identity').lower() != 'identity':
+        return False
+    if response.status == 206:
+        return response.headers.get('content-range', '').startswith('bytes 0-')
+    return response.headers.get('accept-ranges', '').lower() == 'bytes'
+
+def merge_ranges(ranges):
+    """Merge overlapping or adjacent [start, end) ranges"""
+    merged = []
+    for start, end in sorted(r for r in ranges if r[1] > r[0]):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+class PartialDownload:
+    """Interrupted download on disk - a .part file plus a JSON sidecar of the ranges written"""
+    
+    def __init__(self, filepath, url, etag='', last_modified='', total_size=0):
+        self.filepath = filepath
+        self.part_path = filepath + '.part'
+        self.state_path = filepath + '.part.json'
+        self.url = url
+        self.etag = etag
+        self.last_modified = last_modified
+        self.total_size = total_size
+        self.ranges = []
+    
+    @classmethod
+    def load(cls, filepath, url, response, total_size):
+        """Load saved state, keeping it only if the origin file is unchanged"""
+        partial = cls(
+            filepath, url,
+            etag=response.headers.get('etag', ''),
+            last_modified=response.headers.get('last-modified', ''),
+            total_size=total_size
+        )
+        try:
+            with open(partial.state_path, 'r') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return partial
+        
+        if (partial.validator and
+                state.get('url') == url and
+                state.get('etag', '') == partial.etag and
+                state.get('last_modified', '') == partial.last_modified and
+                state.get('total_size') == total_size and
+                os.path.exists(partial.part_path) and
+                os.path.getsize(partial.part_path) == total_size):
+            partial.ranges = merge_ranges(state.get('ranges', []))
+        return partial
+    
+    @property
+    def validator(self):
+        """Value for If-Range - only strong ETags or Last-Modified qualify"""
+        if self.etag and not self.etag.startswith('W/'):
+            return self.etag
+        return self.last_modified
+    
+    @property
+    def completed(self):
+        """Bytes already on disk"""
+        return sum(end - start for start, end in self.ranges)
+    
+    def save(self, ranges):
+        """Persist completed ranges atomically"""
+        self.ranges = merge_ranges(ranges)
+        state = {
+            'url': self.url,
+            'etag': self.etag,
+            'last_modified': self.last_modified,
+            'total_size': self.total_size,
+            'ranges': self.ranges,
+            'updated': time.time()
+        }
+        tmp_path = self.state_path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(state, f)
+            os.replace(tmp_path, self.state_path)
+        except OSError as e:
+            print(f"Could not save download state: {e}")
+    
+    def finish(self):
+        """Move the completed .part file into place and drop the sidecar"""
+        os.replace(self.part_path, self.filepath)
+        self.discard_state()
+    
+    def discard_state(self):
+        """Forget saved progress"""
+        self.ranges = []
+        try:
+            os.remove(self.state_path)
+        except OSError:
+            pass
+    
+    def discard(self):
+        """Delete the partial data together with its state"""
+        self.discard_state()
+        try:
+            os.remove(self.part_path)
+        except OSError:
+            pass
+
+class Segment:
+    """A byte range [start, end) of a file being downloaded"""
+    
+    def __init__(self, start, end):
+        self.start = start
+        self.pos = start  # Handed to the disk writer
+        self.received = start  # Read from the network, may still be buffered
+        self.end = end
+        self.active = False
+
+class SegmentPlan:
+    """Work-stealing byte range allocator shared by segment workers"""
+    
+    def __init__(self, total_size, completed=()):
+        self.total_size = total_size
+        self.completed = merge_ranges(completed)
+        self.segments = []
+        
+        # Only the gaps between already completed ranges need fetching
+        pos = 0
+        for start, end in self.completed + [[total_size, total_size]]:
+            if start > pos:
+                self.segments.append(Segment(pos, start))
+            pos = max(pos, end)
+        
+        self.downloaded = sum(end - start for start, end in self.completed)
+    
+    def done_ranges(self):
+        """All byte ranges written so far"""
+        return self.completed + [[s.start, s.pos] for s in self.segments]
+    
+    def _splittable(self):
+        """Active segment with the most bytes left, if it is worth splitting"""
+        candidates = [s for s in self.segments if s.active and s.end - s.received >= 2 * Config.MIN_SEGMENT_SIZE]
+        return max(candidates, key=lambda s: s.end - s.received, default=None)
+    
+    def has_work(self):
+        """Check if another worker would get a range"""
+        return any(not s.active and s.pos < s.end for s in self.segments) or self._splittable() is not None
+    
+    def next_segment(self):
+        """Hand out an idle range or split the largest one in flight"""
+        for segment in self.segments:
+            if not segment.active and segment.pos < segment.end:
+                segment.active = True
+                return segment
+        
+        victim = self._splittable()
+        if victim is None:
+            return None
+        
+        mid = victim.received + (victim.end - victim.received) // 2
+        segment = Segment(mid, victim.end)
+        segment.active = True
+        victim.end = mid
+        self.segments.append(segment)
+        return segment
+
+class InflightDownload:
+    """A running transfer shared by everyone who requested the same content"""
+    
+    def __init__(self):
+        self.task = None
+        self.token = CancelToken()
+        self.callbacks = []
+        self.consumers = 0
+        self.last_progress = None
+    
+    async def progress(self, current, total, status="Downloading", **details):
+        """Fan a progress update (and details like speed/eta) out to every attached requester"""
+        self.last_progress = (current, total, status)
+        callbacks = [cb for cb in self.callbacks if cb]
+        if callbacks:
+            await asyncio.gather(*(cb(current, total, status, **details) for cb in callbacks), return_exceptions=True)
+
 class Downloader:
     def __init__(self):
         self.download_dir = Config.DOWNLOAD_DIR
         self.torrent_dir = Config.TORRENT_DOWNLOAD_PATH
+        self._session = None
+        self._inflight = {}  # content key -> InflightDownload
+        self._refs = {}  # finished path -> number of requesters still using it
+        self._claimed = set()  # paths currently being written
+        self.cache = DownloadCache(os.path.join(self.download_dir, 'cache'), Config.DOWNLOAD_CACHE_SIZE)
+        self.video_info = InfoCache(Config.YTDLP_INFO_TTL)  # normalized URL -> probed yt-dlp info
+        self.strategies = StrategyStats(os.path.join(self.download_dir, 'strategy_stats.json'))
+        self.resolvers = ResolverRegistry(Config.ROUTE_CACHE_SIZE, Config.ROUTE_LEARN_TTL)
+        self.resolvers.register(TorrentResolver())
+        self.resolvers.register(ManifestResolver())
+        self.resolvers.register(DomainResolver('ytdlp', VIDEO_DOMAINS))
+        self.resolvers.register(ExtractorResolver())
+        self.torrents = TorrentSession(self.torrent_dir, Config.TORRENT_STATE_PATH)
+        self.disk = DiskSpace(self.download_dir, Config.MIN_FREE_SPACE, Config.DISK_HIGH_WATER)
         if not os.path.exists(self.download_dir):
             os.makedirs(self.download_dir)
         if not os.path.exists(self.torrent_dir):
             os.makedirs(self.torrent_dir)
 
-    async def download_file(self, url, filename=None, progress_callback=None):
+    async def start(self):
+        """Open the shared HTTP session, torrent session and yt-dlp workers used by every download path"""
+        self.torrents.start()
+        ytdlp_pool.start()
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=Config.HTTP_POOL_SIZE,
+                limit_per_host=Config.HTTP_POOL_PER_HOST,
+                ttl_dns_cache=Config.DNS_CACHE_TTL,
+                keepalive_timeout=Config.HTTP_KEEPALIVE,
+                force_close=False,
+                enable_cleanup_closed=True
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=None, connect=30, sock_read=30),
+                headers={
+                    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+                    'Accept': '*/*',
+                }
+            )
+        return self._session
+
+    async def close(self):
+        """Close the shared HTTP session, its pooled connections, the torrent session and yt-dlp workers"""
+        await self.torrents.stop()
+        await ytdlp_pool.stop()
+        self.strategies.save()
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def get_session(self):
+        """Get the shared HTTP session, opening it on first use"""
+        if self._session is None or self._session.closed:
+            return await self.start()
+        return self._session
+
+    async def download_file(self, url, filename=None, progress_callback=None, share=None, token=None, extra_headers=None):
         """Download file from URL using aiohttp with maximum speed - preserves original quality"""
+        claimed = None
         try:
-            timeout = aiohttp.ClientTimeout(total=None, connect=30, sock_read=30)
+            session = await self.get_session()
             headers = {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
-                'Accept': '*/*',
+                **(extra_headers or {}),
                 'Accept-Encoding': 'gzip, deflate, br',
-                'Connection': 'keep-alive',
                 'Range': 'bytes=0-'
             }
-            connector = aiohttp.TCPConnector(
-                limit=100,
-                limit_per_host=30,
-                ttl_dns_cache=300,
-                force_close=False,
-                enable_cleanup_closed=True
-            )
             
-            async with aiohttp.ClientSession(
-                timeout=timeout, 
-                headers=headers,
-                connector=connector
-            ) as session:
-                async with session.get(url, allow_redirects=True) as response:
+            url_key = normalize_url(url)
+            cached = self.cache.lookup(url_key)
+            probe_headers = dict(headers, **self.cache.conditional_headers(cached)) if cached else headers
+            
+            async with session.get(url, headers=probe_headers, allow_redirects=True) as response:
+                if cached and response.status == 304:
+                    filepath = self._claim_path(os.path.join(self.download_dir, filename or cached['name']))
+                    claimed = filepath
+                    self.cache.checkout(cached, filepath)
+                    if progress_callback:
+                        size = os.path.getsize(filepath)
+                        await progress_callback(size, size, "Downloading (cached copy)")
+                    return filepath, None
+                
+                if cached:
+                    self.cache.forget(url_key)
+                
+                if response.status not in (200, 206):
+                    return None, f"Failed to download: HTTP {response.status}"
+                
+                etag = response.headers.get('etag', '')
+                last_modified = response.headers.get('last-modified', '')
+                
+                total_size = get_total_size(response)
+                
+                error = self.check_size(total_size)
+                if error:
+                    return None, error
+                
+                if not filename:
+                    content_disp = response.headers.get('content-disposition', '')
+                    if 'filename=' in content_disp:
+                        filename = content_disp.split('filename=')[1].strip('"\'')
+                    else:
+                        filename = url.split('/')[-1].split('?')[0] or 'downloaded_file'
+                
+                filename = sanitize_filename(filename)
+                filename = truncate_filename(filename)
+                filepath = self._claim_path(os.path.join(self.download_dir, filename))
+                claimed = filepath
+                
+                reserved = self.disk.try_reserve(token, total_size)
+                ranged = supports_ranges(response, total_size)
+                if reserved and not ranged:
+                    await self._download_stream(response, filepath, total_size, progress_callback, share)
+                    await self.cache.store(url_key, filepath, etag, last_modified)
+                    return filepath, None
+                
+                final_url = str(response.url)
+                partial = PartialDownload.load(filepath, url, response, total_size) if ranged else None
+            
+            if not reserved:
+                # Wait with the connection closed, the transfer starts over with fresh requests
+                error = await self.disk.reserve(token, total_size, self._space_wait(progress_callback))
+                if error:
+                    return None, error
+            
+            try:
+                if partial is None:
+                    raise RangeNotSupported("Single stream")
+                await self._download_segmented(session, final_url, partial, progress_callback, share, extra_headers)
+            except RangeNotSupported:
+                # Server ignored ranges or the file changed - single stream instead
+                if partial is not None:
+                    partial.discard_state()
+                async with session.get(url, headers=headers, allow_redirects=True) as response:
                     if response.status not in (200, 206):
                         return None, f"Failed to download: HTTP {response.status}"
+                    etag = response.headers.get('etag', '')
+                    last_modified = response.headers.get('last-modified', '')
+                    await self._download_stream(response, filepath, total_size, progress_callback, share)
+            
+            await self.cache.store(url_key, filepath, etag, last_modified)
+            return filepath, None
                     
-                    total_size = int(response.headers.get('content-length', 0))
-                    
-                    if total_size > Config.MAX_FILE_SIZE:
-                        return None, "File size exceeds 4GB limit"
-                    
-                    if not filename:
-                        content_disp = response.headers.get('content-disposition', '')
-                        if 'filename=' in content_disp:
-                            filename = content_disp.split('filename=')[1].strip('"\'')
-                        else:
-                            filename = url.split('/')[-1].split('?')[0] or 'downloaded_file'
-                    
-                    filename = sanitize_filename(filename)
-                    filename = truncate_filename(filename)
-                    filepath = os.path.join(self.download_dir, filename)
-                    
-                    downloaded = 0
-                    start_time = time.time()
-                    last_update = 0
-                    chunk_size = 10 * 1024 * 1024
-                    
-                    with open(filepath, 'wb') as f:
-                        async for chunk in response.content.iter_chunked(chunk_size):
-                            f.write(chunk)
-                            downloaded += len(chunk)
-                            
-                            current_time = time.time()
-                            if progress_callback and (current_time - last_update) >= 1:
-                                last_update = current_time
-                                speed = downloaded / (current_time - start_time) / (1024 * 1024)
-                                await progress_callback(downloaded, total_size, f"Downloading ({speed:.1f} MB/s)")
-                    
-                    return filepath, None
-                    
+        except asyncio.CancelledError:
+            if claimed and token is not None and token.cancelled:
+                PartialDownload(claimed, url).discard()
+            raise
+        except FileTooLarge as e:
+            PartialDownload(claimed, url).discard()
+            return None, str(e)
         except asyncio.TimeoutError:
             return None, "Download timeout - server too slow"
         except aiohttp.ClientError as e:
             return None, f"Network error: {str(e)}"
         except Exception as e:
             return None, f"Download error: {str(e)}"
+        finally:
+            self._claimed.discard(claimed)
+
+    def _claim_path(self, filepath):
+        """Reserve an output path no other download is writing or sharing"""
+        candidate = filepath
+        name, ext = os.path.splitext(filepath)
+        n = 1
+        while candidate in self._claimed or self._refs.get(candidate):
+            candidate = f"{name} ({n}){ext}"
+            n += 1
+        self._claimed.add(candidate)
+        return candidate
+
+    async def _download_stream(self, response, filepath, total_size, progress_callback=None, share=None):
+        """Write a single response body to disk"""
+        downloaded = 0
+        start_time = time.time()
+        last_update = 0
+        part_path = filepath + '.part'
+        
+        async with FileWriter(part_path) as writer:
+            async for chunk in response.content.iter_chunked(Config.CHUNK_SIZE):
+                downloaded += len(chunk)
+                # Without (or despite) a Content-Length, stop at the limit rather than at the end
+                if downloaded > Config.MAX_FILE_SIZE:
+                    raise FileTooLarge(f"File exceeds the {format_bytes(Config.MAX_FILE_SIZE)} limit")
+                await writer.write(chunk)
+                await download_bandwidth.throttle(share, len(chunk))
+                
+                current_time = time.time()
+                if progress_callback and (current_time - last_update) >= 1:
+                    last_update = current_time
+                    speed = downloaded / (current_time - start_time) / (1024 * 1024)
+                    await progress_callback(downloaded, total_size, f"Downloading ({speed:.1f} MB/s)")
+        
+        os.replace(part_path, filepath)
 
-    async def download_tiktok_fallback(self, url, progress_callback=None):
-        """Fallback method to download TikTok videos using multiple approaches"""
+    async def _download_segmented(self, session, url, partial, progress_callback=None, share=None, extra_headers=None):
+        """Download byte ranges over a growing set of parallel connections into a preallocated file"""
+        total_size = partial.total_size
+        plan = SegmentPlan(total_size, partial.ranges)
+        resumed = plan.downloaded
+        writer = FileWriter(partial.part_path, truncate=not partial.ranges)
+        workers = set()
+        
+        def spawn(count):
+            for _ in range(count):
+                if len(workers) >= Config.MAX_CONNECTIONS or not plan.has_work():
+                    break
+                workers.add(asyncio.create_task(
+                    self._segment_worker(session, url, writer, plan, partial.validator, share, extra_headers)
+                ))
+        
         try:
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36',
-                'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-            }
+            writer.truncate(total_size)
+            spawn(Config.INITIAL_CONNECTIONS)
             
-            timeout = aiohttp.ClientTimeout(total=30, connect=10)
+            start_time = time.time()
+            last_check = start_time
+            last_bytes = plan.downloaded
+            last_rate = 0
+            last_save = start_time
+            growing = True
             
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                # Step 1: Resolve short URL to get full URL and video ID
-                resolved_url = url
-                if 'vm.tiktok.com' in url or 'vt.tiktok.com' in url:
-                    try:
-                        async with session.get(url, headers=headers, allow_redirects=True) as resp:
-                            resolved_url = str(resp.url)
-                    except:
-                        pass
-                
-                # Extract video ID
-                video_id = None
-                patterns = [
-                    r'tiktok\.com.*?/video/(\d+)',
-                    r'tiktok\.com.*?/v/(\d+)',
-                    r'@[\w\.]+/video/(\d+)',
-                ]
+            while workers:
+                done, _ = await asyncio.wait(workers, timeout=1, return_when=asyncio.FIRST_EXCEPTION)
+                for task in done:
+                    workers.discard(task)
+                    task.result()
                 
-                for pattern in patterns:
-                    match = re.search(pattern, resolved_url)
-                    if match:
-                        video_id = match.group(1)
-                        break
+                now = time.time()
+                if growing and now - last_check >= 2:
+                    rate = (plan.downloaded - last_bytes) / (now - last_check)
+                    if rate > last_rate * 1.15:
+                        spawn(max(1, len(workers) // 2))
+                    else:
+                        growing = False
+                    last_rate = rate
+                    last_bytes = plan.downloaded
+                    last_check = now
                 
-                if not video_id:
-                    return None, "Could not extract TikTok video ID from URL"
-                
-                if progress_callback:
-                    await progress_callback(10, 100, f"Found video ID: {video_id}")
+                if now - last_save >= 5:
+                    last_save = now
+                    await writer.drain()
+                    partial.save(plan.done_ranges())
                 
-                # Step 2: Try TikTok's webpage scraping method
-                try:
-                    if progress_callback:
-                        await progress_callback(20, 100, "Fetching video page...")
+                if progress_callback and workers:
+                    speed = (plan.downloaded - resumed) / max(now - start_time, 0.001) / (1024 * 1024)
+                    await progress_callback(
+                        plan.downloaded, total_size,
+                        f"Downloading ({speed:.1f} MB/s, {len(workers)} connections)"
+                    )
+            
+            if plan.downloaded < total_size:
+                raise aiohttp.ClientPayloadError("Download incomplete")
+            await writer.close()
+        except BaseException:
+            for task in workers:
+                task.cancel()
+            if workers:
+                await asyncio.gather(*workers, return_exceptions=True)
+            try:
+                await writer.close()
+            finally:
+                partial.save(plan.done_ranges())
+            raise
+        
+        partial.finish()
+
+    async def _segment_worker(self, session, url, writer, plan, validator='', share=None, extra_headers=None):
+        """Fetch ranges from the plan until nothing is left to steal"""
+        segment = plan.next_segment()
+        while segment:
+            await self._fetch_segment(session, url, writer, segment, plan, validator, share, extra_headers)
+            segment = plan.next_segment()
+
+    async def _fetch_segment(self, session, url, writer, segment, plan, validator='', share=None, extra_headers=None):
+        """Fetch one byte range, resuming from its current position on errors"""
+        retries = 0
+        buffer = bytearray()
+        
+        async def flush():
+            data = bytes(buffer)
+            buffer.clear()
+            await writer.write(data, segment.pos)
+            segment.pos += len(data)
+        
+        while segment.received < segment.end:
+            headers = {
+                **(extra_headers or {}),
+                'Range': f'bytes={segment.received}-{segment.end - 1}',
+                'Accept-Encoding': 'identity'
+            }
+            if validator:
+                # Origin answers 200 instead of 206 if the file changed meanwhile
+                headers['If-Range'] = validator
+            try:
+                async with session.get(url, headers=headers) as response:
+                    if response.status != 206:
+                        raise RangeNotSupported(f"HTTP {response.status} for range request")
                     
-                    async with session.get(resolved_url, headers=headers) as resp:
-                        if resp.status == 200:
-                            html = await resp.text()
-                            
-                            # Method 1: Try to find video URL in __UNIVERSAL_DATA_FOR_REHYDRATION__
-                            if '__UNIVERSAL_DATA_FOR_REHYDRATION__' in html:
-                                try:
-                                    start = html.find('__UNIVERSAL_DATA_FOR_REHYDRATION__') + len('__UNIVERSAL_DATA_FOR_REHYDRATION__') + 1
-                                    end = html.find('</script>', start)
-                                    json_str = html[start:end].strip()
-                                    
-                                    if json_str:
-                                        data = json.loads(json_str)
-                                        
-                                        # Navigate through the nested structure
-                                        default_scope = data.get('__DEFAULT_SCOPE__', {})
-                                        webapp_video = default_scope.get('webapp.video-detail', {})
-                                        item_info = webapp_video.get('itemInfo', {}).get('itemStruct', {})
-                                        video_data = item_info.get('video', {})
-                                        
-                                        # Try different video URL fields
-                                        video_url = None
-                                        if 'downloadAddr' in video_data:
-                                            video_url = video_data['downloadAddr']
-                                        elif 'playAddr' in video_data:
-                                            video_url = video_data['playAddr']
-                                        elif 'playApi' in video_data:
-                                            video_url = video_data['playApi']
-                                        
-                                        if video_url:
-                                            if progress_callback:
-                                                await progress_callback(50, 100, "Found video URL, downloading...")
-                                            
-                                            filename = f"tiktok_{video_id}.mp4"
-                                            
-                                            # Download the video with TikTok headers
-                                            download_headers = {
-                                                'User-Agent': headers['User-Agent'],
-                                                'Referer': 'https://www.tiktok.com/',
-                                                'Accept': '*/*',
-                                            }
-                                            
-                                            async with session.get(video_url, headers=download_headers, allow_redirects=True) as video_resp:
-                                                if video_resp.status == 200:
-                                                    filepath = os.path.join(self.download_dir, filename)
-                                                    total_size = int(video_resp.headers.get('content-length', 0))
-                                                    
-                                                    downloaded = 0
-                                                    with open(filepath, 'wb') as f:
-                                                        async for chunk in video_resp.content.iter_chunked(1024 * 1024):
-                                                            f.write(chunk)
-                                                            downloaded += len(chunk)
-                                                            if progress_callback and total_size > 0:
-                                                                await progress_callback(downloaded, total_size, "Downloading video...")
-                                                    
-                                                    if os.path.exists(filepath):
-                                                        return filepath, None
-                                except json.JSONDecodeError:
-                                    pass
-                            
-                            # Method 2: Try SIGI_STATE approach
-                            if 'SIGI_STATE' in html:
-                                try:
-                                    start = html.find('SIGI_STATE') + len('SIGI_STATE') + 1
-                                    end = html.find('</script>', start)
-                                    json_str = html[start:end].strip()
-                                    
-                                    if json_str:
-                                        data = json.loads(json_str)
-                                        item_module = data.get('ItemModule', {})
-                                        
-                                        for key, item in item_module.items():
-                                            if isinstance(item, dict) and 'video' in item:
-                                                video_data = item['video']
-                                                video_url = video_data.get('downloadAddr') or video_data.get('playAddr')
-                                                
-                                                if video_url:
-                                                    filename = f"tiktok_{video_id}.mp4"
-                                                    return await self.download_file(video_url, filename, progress_callback)
-                                except:
-                                    pass
-                except Exception as e:
-                    if progress_callback:
-                        await progress_callback(30, 100, f"Webpage method failed, trying API...")
-                
-                # Step 3: Try third-party API services (these are public APIs)
-                api_services = [
-                    f"https://www.tikwm.com/api/?url={resolved_url}",
-                    f"https://api.tiktokv.com/aweme/v1/feed/?aweme_id={video_id}",
-                ]
-                
-                for api_url in api_services:
-                    try:
-                        if progress_callback:
-                            await progress_callback(40, 100, "Trying alternative API...")
-                        
-                        async with session.get(api_url, headers=headers, timeout=aiohttp.ClientTimeout(total=15)) as resp:
-                            if resp.status == 200:
-                                data = await resp.json()
-                                
-                                # tikwm.com API response
-                                if 'data' in data:
-                                    video_url = data['data'].get('play') or data['data'].get('hdplay') or data['data'].get('wmplay')
-                                    if video_url:
-                                        filename = f"tiktok_{video_id}.mp4"
-                                        return await self.download_file(video_url, filename, progress_callback)
-                                
-                                # TikTok API response
-                                elif 'aweme_list' in data:
-                                    aweme_list = data.get('aweme_list', [])
-                                    if aweme_list:
-                                        video_data = aweme_list[0].get('video', {})
-                                        play_addr = video_data.get('play_addr', {})
-                                        url_list = play_addr.get('url_list', [])
-                                        
-                                        if url_list:
-                                            video_url = url_list[0]
-                                            filename = f"tiktok_{video_id}.mp4"
-                                            return await self.download_file(video_url, filename, progress_callback)
-                    except Exception as e:
-                        continue
+                    async for chunk in response.content.iter_chunked(Config.CHUNK_SIZE):
+                        # The range may have been shortened by a split meanwhile
+                        remaining = segment.end - segment.received
+                        if len(chunk) > remaining:
+                            chunk = chunk[:remaining]
+                        buffer += chunk
+                        segment.received += len(chunk)
+                        plan.downloaded += len(chunk)
+                        retries = 0
+                        if len(buffer) >= writer.buffer_size:
+                            await flush()
+                        await download_bandwidth.throttle(share, len(chunk))
+                        if segment.received >= segment.end:
+                            break
+                    else:
+                        if segment.received < segment.end:
+                            raise aiohttp.ClientPayloadError("Range ended early")
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                retries += 1
+                if retries > Config.SEGMENT_RETRIES:
+                    raise
+                await asyncio.sleep(min(2 ** retries, 10))
+            finally:
+                if buffer:
+                    await flush()
+
+    async def download_hls(self, url, filename=None, progress_callback=None, share=None, token=None):
+        """Download an HLS stream without yt-dlp"""
+        session = await self.get_session()
+        ffmpeg = shutil.which('ffmpeg')
+        
+        if progress_callback:
+            await progress_callback(0, 100, "Reading stream playlist...")
+        
+        try:
+            playlist = await self._fetch_playlist(session, url)
+            bandwidth = 0
+            tracks = [playlist]
+            if isinstance(playlist, MasterPlaylist):
+                if not playlist.variants:
+                    raise UnsupportedManifest("No variants in master playlist")
+                # Every variant covers the same duration, the top one tells it
+                top = max(playlist.variants, key=lambda v: v.bandwidth)
+                media = await self._fetch_media(session, top.url)
+                variant = playlist.pick(media.duration, Config.MAX_FILE_SIZE)
+                if variant is None:
+                    return None, f"No variant of this stream fits the {format_bytes(Config.MAX_FILE_SIZE)} limit"
+                bandwidth = variant.bandwidth
+                tracks = [media if variant is top else await self._fetch_media(session, variant.url)]
+                audio_url = playlist.audio.get(variant.audio_group)
+                if audio_url:
+                    if not ffmpeg:
+                        raise UnsupportedManifest("Separate audio needs ffmpeg")
+                    tracks.append(await self._fetch_media(session, audio_url))
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            return None, f"Stream playlist error: {str(e)}"
+        
+        total_duration = sum(track.duration for track in tracks)
+        estimate = int(bandwidth / 8 * tracks[0].duration)
+        error = await self.disk.reserve(token, estimate, self._space_wait(progress_callback))
+        if error:
+            return None, error
+        
+        name = filename or os.path.basename(urlparse(url).path)
+        filename = truncate_filename(sanitize_filename(os.path.splitext(name)[0] or 'stream') + '.mp4')
+        filepath = claimed = self._claim_path(os.path.join(self.download_dir, filename))
+        parts = [f"{filepath}.{n}.part" for n in range(len(tracks))]
+        
+        done_bytes = 0
+        done_seconds = 0.0
+        
+        async def on_segment(nbytes, seconds):
+            nonlocal done_bytes, done_seconds
+            done_bytes += nbytes
+            done_seconds += seconds
+            # Extrapolate from what arrived so far, the bandwidth guess only until then
+            total = int(done_bytes / done_seconds * total_duration) if done_seconds else estimate
+            if total > Config.MAX_FILE_SIZE and done_seconds > total_duration / 10:
+                raise ValueError(f"Stream size (~{format_bytes(total)}) exceeds limit")
+            if progress_callback:
+                await progress_callback(done_bytes, max(total, done_bytes), "Downloading stream...")
+        
+        try:
+            for track, part in zip(tracks, parts):
+                await self._download_track(session, track, part, on_segment, share)
             
-            return None, "All TikTok download methods failed"
+            if ffmpeg:
+                if progress_callback:
+                    await progress_callback(0, 100, "Processing stream...")
+                await self._remux(parts, filepath)
+            else:
+                # Plain concatenated segments - still playable, just not MP4
+                if not tracks[0].init:
+                    self._claimed.discard(claimed)
+                    filepath = claimed = self._claim_path(os.path.splitext(filepath)[0] + '.ts')
+                os.replace(parts[0], filepath)
             
-        except Exception as e:
-            return None, f"TikTok fallback error: {str(e)}"
+            return filepath, None
+        except asyncio.CancelledError:
+            if token is not None and token.cancelled:
+                self._remove_quietly(filepath)
+            raise
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            return None, f"Stream download error: {str(e)}"
+        except ValueError as e:
+            return None, str(e)
+        finally:
+            for part in parts:
+                self._remove_quietly(part)
+            self._claimed.discard(claimed)
+    
+    async def _fetch_playlist(self, session, url):
+        async with session.get(url, allow_redirects=True) as response:
+            if response.status != 200:
+                raise UnsupportedManifest(f"Playlist returned HTTP {response.status}")
+            text = await response.text()
+        try:
+            return parse_hls(text, str(response.url))
+        except (ValueError, KeyError) as e:
+            raise UnsupportedManifest(f"Unreadable playlist: {e}")
+    
+    async def _fetch_media(self, session, url):
+        """Fetch a playlist a master points to, which has to list segments"""
+        playlist = await self._fetch_playlist(session, url)
+        if isinstance(playlist, MasterPlaylist):
+            raise UnsupportedManifest("Master playlist nested in a master playlist")
+        return playlist
+    
+    async def _download_track(self, session, playlist, path, on_segment, share=None):
+        """Fetch a media playlist's segments in parallel and write them in order"""
+        segments = ([playlist.init] if playlist.init else []) + playlist.segments
+        tasks = {}
+        try:
+            async with FileWriter(path) as writer:
+                for index, segment in enumerate(segments):
+                    # Keep MAX_CONNECTIONS segments in flight ahead of the writer
+                    for ahead in range(index, min(index + Config.MAX_CONNECTIONS, len(segments))):
+                        if ahead not in tasks:
+                            tasks[ahead] = asyncio.create_task(self._fetch_media_segment(session, segments[ahead], share))
+                    data = await tasks.pop(index)
+                    await writer.write(data)
+                    await on_segment(len(data), segment.duration)
+        finally:
+            for task in tasks.values():
+                task.cancel()
+            # Collect what the cancelled ones raised so none goes unretrieved
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+    
+    async def _fetch_media_segment(self, session, segment, share=None):
+        """Download one segment into memory, retrying like a byte range"""
+        retries = 0
+        while True:
+            try:
+                async with session.get(segment.url, headers=segment.headers, allow_redirects=True) as response:
+                    if response.status not in (200, 206):
+                        raise aiohttp.ClientResponseError(
+                            response.request_info, response.history,
+                            status=response.status, message=f"Segment returned HTTP {response.status}"
+                        )
+                    data = bytearray()
+                    async for chunk in response.content.iter_chunked(Config.CHUNK_SIZE):
+                        data += chunk
+                        await download_bandwidth.throttle(share, len(chunk))
+                    # Server ignored the byte range and sent the whole file
+                    if segment.byte_range and response.status == 200:
+                        data = data[segment.byte_range[0]:segment.byte_range[1] + 1]
+                    return bytes(data)
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                retries += 1
+                if retries > Config.SEGMENT_RETRIES:
+                    raise
+                await asyncio.sleep(min(2 ** retries, 10))
+    
+    async def _remux(self, inputs, output):
+        """Copy the streams of the downloaded tracks into one MP4"""
+        args = ['ffmpeg', '-y', '-v', 'error', '-i', inputs[0]]
+        maps = ['-map', '0:v?', '-map', '0:a?']
+        for n, path in enumerate(inputs[1:], start=1):
+            args += ['-i', path]
+            maps += ['-map', f'{n}:a']
+        args += maps + ['-c', 'copy', '-movflags', '+faststart', output]
+        
+        process = await asyncio.create_subprocess_exec(
+            *args, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE
+        )
+        try:
+            _, stderr = await process.communicate()
+        except asyncio.CancelledError:
+            process.kill()
+            raise
+        if process.returncode != 0:
+            self._remove_quietly(output)
+            raise ValueError(f"Stream remux failed: {stderr.decode(errors='replace')[-200:]}")
+    
+    def _remove_quietly(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    
+    async def resolve_tiktok(self, url, ydl_opts, progress_callback=None, token=None):
+        """Race the TikTok sources, best-ranked first - the winner, or None if yt-dlp never ran"""
+        session = await self.get_session()
+        headers = {
+            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36',
+            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
+        }
+        
+        if progress_callback:
+            await progress_callback(0, 100, "Resolving TikTok video...")
+        
+        target = asyncio.ensure_future(self._tiktok_target(session, url, headers))
+        
+        def scraper(name, method):
+            async def attempt():
+                resolved = await asyncio.shield(target)
+                if resolved is None:
+                    return None
+                started = time.monotonic()
+                try:
+                    video_url = await method(session, *resolved, headers)
+                except Exception:
+                    self.strategies.record(TIKTOK_SITE, name, False)
+                    raise
+                if not video_url:
+                    self.strategies.record(TIKTOK_SITE, name, False)
+                    return None
+                # Success is recorded once the download got its first byte
+                return {
+                    'strategy': name,
+                    'started': started,
+                    'url': video_url,
+                    'filename': f"tiktok_{resolved[1]}.mp4",
+                    'headers': {
+                        'User-Agent': headers['User-Agent'],
+                        'Referer': 'https://www.tiktok.com/',
+                        'Accept': '*/*',
+                    }
+                }
+            return attempt
+        
+        ytdlp_error = None
+        
+        async def ytdlp_probe():
+            nonlocal ytdlp_error
+            started = time.monotonic()
+            try:
+                info, cached = await self.probe_ytdlp(url, ydl_opts, token=token)
+            except Exception as e:
+                ytdlp_error = e
+                if not (token and token.cancelled):
+                    self.strategies.record(TIKTOK_SITE, 'ytdlp', False)
+                raise
+            return {'strategy': 'ytdlp', 'started': started, 'info': info, 'cached': cached}
+        
+        sources = {
+            'page': scraper('page', self._tiktok_from_page),
+            'tikwm': scraper('tikwm', self._tiktok_from_tikwm),
+            'aweme': scraper('aweme', self._tiktok_from_aweme),
+            'ytdlp': ytdlp_probe,
+        }
+        attempts = []
+        for position, name in enumerate(self.strategies.rank(TIKTOK_SITE, list(sources))):
+            if position == 0 or (name != 'ytdlp' and not self.strategies.measured(TIKTOK_SITE, name)):
+                delay = 0
+            else:
+                delay = position * Config.TIKTOK_HEDGE_DELAY
+            attempts.append((delay, sources[name]))
+        
+        try:
+            winner = await race(attempts)
+        finally:
+            target.cancel()
+        
+        if winner is None:
+            if ytdlp_error is not None:
+                raise ytdlp_error
+            return None
+        winner['ytdlp_error'] = ytdlp_error
+        return winner
+    
+    async def _tiktok_target(self, session, url, headers):
+        """Expand a short link and pull out the video ID - (page URL, ID) or None"""
+        resolved_url = url
+        if 'vm.tiktok.com' in url or 'vt.tiktok.com' in url:
+            try:
+                async with session.get(url, headers=headers, timeout=aiohttp.ClientTimeout(total=30, connect=10), allow_redirects=True) as resp:
+                    resolved_url = str(resp.url)
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                pass
+        
+        patterns = [
+            r'tiktok\.com.*?/video/(\d+)',
+            r'tiktok\.com.*?/v/(\d+)',
+            r'@[\w\.]+/video/(\d+)',
+        ]
+        for pattern in patterns:
+            match = re.search(pattern, resolved_url)
+            if match:
+                return resolved_url, match.group(1)
+        return None
+    
+    async def _tiktok_from_page(self, session, page_url, video_id, headers):
+        """Media URL from the JSON TikTok embeds in the video page"""
+        async with session.get(page_url, headers=headers, timeout=aiohttp.ClientTimeout(total=30, connect=10)) as resp:
+            if resp.status != 200:
+                return None
+            html = await resp.text()
+        
+        # Method 1: __UNIVERSAL_DATA_FOR_REHYDRATION__
+        if '__UNIVERSAL_DATA_FOR_REHYDRATION__' in html:
+            try:
+                start = html.find('__UNIVERSAL_DATA_FOR_REHYDRATION__') + len('__UNIVERSAL_DATA_FOR_REHYDRATION__') + 1
+                end = html.find('</script>', start)
+                json_str = html[start:end].strip()
+                if json_str:
+                    data = json.loads(json_str)
+                    default_scope = data.get('__DEFAULT_SCOPE__', {})
+                    webapp_video = default_scope.get('webapp.video-detail', {})
+                    item_info = webapp_video.get('itemInfo', {}).get('itemStruct', {})
+                    video_data = item_info.get('video', {})
+                    video_url = video_data.get('downloadAddr') or video_data.get('playAddr') or video_data.get('playApi')
+                    if video_url:
+                        return video_url
+            except json.JSONDecodeError:
+                pass
+        
+        # Method 2: SIGI_STATE
+        if 'SIGI_STATE' in html:
+            try:
+                start = html.find('SIGI_STATE') + len('SIGI_STATE') + 1
+                end = html.find('</script>', start)
+                json_str = html[start:end].strip()
+                if json_str:
+                    data = json.loads(json_str)
+                    for key, item in data.get('ItemModule', {}).items():
+                        if isinstance(item, dict) and 'video' in item:
+                            video_url = item['video'].get('downloadAddr') or item['video'].get('playAddr')
+                            if video_url:
+                                return video_url
+            except (json.JSONDecodeError, AttributeError):
+                pass
+        return None
+    
+    async def _tiktok_from_tikwm(self, session, page_url, video_id, headers):
+        """Media URL from the tikwm.com public API"""
+        async with session.get(f"https://www.tikwm.com/api/?url={page_url}", headers=headers, timeout=aiohttp.ClientTimeout(total=15)) as resp:
+            if resp.status != 200:
+                return None
+            data = await resp.json(content_type=None)
+        video = data.get('data') or {}
+        return video.get('play') or video.get('hdplay') or video.get('wmplay')
+    
+    async def _tiktok_from_aweme(self, session, page_url, video_id, headers):
+        """Media URL from TikTok's own feed API"""
+        async with session.get(f"https://api.tiktokv.com/aweme/v1/feed/?aweme_id={video_id}", headers=headers, timeout=aiohttp.ClientTimeout(total=15)) as resp:
+            if resp.status != 200:
+                return None
+            data = await resp.json(content_type=None)
+        aweme_list = data.get('aweme_list') or []
+        if not aweme_list:
+            return None
+        url_list = aweme_list[0].get('video', {}).get('play_addr', {}).get('url_list', [])
+        return url_list[0] if url_list else None
 
-    async def download_ytdlp(self, url, progress_callback=None):
+    async def download_ytdlp(self, url, progress_callback=None, share=None, token=None):
         """Download using yt-dlp with BEST quality - Enhanced TikTok support"""
+        winner = None  # TikTok source whose result is being downloaded
+        first_byte = None  # seconds from the winner's start to its first byte
+        
+        def record_winner(ok):
+            # A cached probe says nothing about how fast yt-dlp is now
+            if winner is not None and not winner.get('cached'):
+                self.strategies.record(TIKTOK_SITE, winner['strategy'], ok, first_byte)
+        
         try:
             # Check yt-dlp version and warn if outdated
             try:
@@ -298,38 +981,25 @@ class Downloader:
             except:
                 pass
             
-            # Check if this is TikTok - use fallback first
-            is_tiktok = any(domain in url.lower() for domain in ['tiktok.com', 'vm.tiktok.com', 'vt.tiktok.com'])
-            
-            if is_tiktok:
-                if progress_callback:
-                    await progress_callback(0, 100, "Trying TikTok direct download...")
-                
-                # Try fallback method first
-                result, error = await self.download_tiktok_fallback(url, progress_callback)
-                if result:
-                    return result, None
-                
-                # If fallback fails, try yt-dlp
-                if progress_callback:
-                    await progress_callback(0, 100, "Trying alternative method...")
-            
             # Generate a short, safe filename template
             url_hash = hashlib.md5(url.encode()).hexdigest()[:12]
             
+            size_filter = f'[filesize<?{Config.MAX_FILE_SIZE}][filesize_approx<?{Config.MAX_FILE_SIZE}]'
             ydl_opts = {
                 'outtmpl': os.path.join(self.download_dir, f'video_{url_hash}_%(id)s.%(ext)s'),
-                'format': 'best[ext=mp4]/best',  # Simplified format for better compatibility
+                # Simplified format for better compatibility, skipping formats known to be too big
+                'format': f'best[ext=mp4]{size_filter}/best{size_filter}',
                 'merge_output_format': 'mp4',
                 'quiet': True,
                 'no_warnings': True,
                 'writethumbnail': False,
                 'no_post_overwrites': True,
-                'concurrent_fragment_downloads': 5,
+                'concurrent_fragment_downloads': Config.MAX_CONNECTIONS,
                 'buffer_size': 16384,
                 'http_chunk_size': 10485760,
                 'cookiesfrombrowser': None,
                 'nocheckcertificate': True,  # Skip certificate verification
+                'max_filesize': Config.MAX_FILE_SIZE,  # Abort formats that turn out bigger than their estimate
                 'http_headers': {
                     'User-Agent': 'Mozilla/5.0 (Linux; Android 10; K) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Mobile Safari/537.36',
                     'Accept': '*/*',
@@ -350,6 +1020,8 @@ class Downloader:
                 'fragment_retries': 15,
                 'skip_unavailable_fragments': True,
                 'keepvideo': False,
+                'continuedl': True,  # Resume leftover .part files from earlier attempts
+                'nopart': False,
                 'socket_timeout': 30,
                 'source_address': '0.0.0.0',
                 'geo_bypass': True,
@@ -357,83 +1029,133 @@ class Downloader:
                 'ignoreerrors': False,
             }
             
-            loop = asyncio.get_event_loop()
+            received = 0
             
-            def download():
-                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                    try:
-                        info = ydl.extract_info(url, download=True)
-                        filename = ydl.prepare_filename(info)
-                        
-                        # Check multiple possible output files
-                        base = os.path.splitext(filename)[0]
-                        possible_files = [
-                            filename,
-                            f"{base}.mp4",
-                            f"{base}.mkv",
-                            f"{base}.webm",
-                        ]
-                        
-                        # Also check the directory for the most recent file with our hash
-                        for file in os.listdir(self.download_dir):
-                            if url_hash in file and file.endswith(('.mp4', '.mkv', '.webm')):
-                                possible_files.append(os.path.join(self.download_dir, file))
-                        
-                        for pfile in possible_files:
-                            if os.path.exists(pfile):
-                                return pfile, info.get('title', 'Video')
-                        
-                        return filename, info.get('title', 'Video')
-                    
-                    except yt_dlp.utils.DownloadError as e:
-                        error_msg = str(e)
-                        # Check if it's a TikTok-specific error
-                        if 'TikTok' in error_msg:
-                            raise Exception(f"TikTok download failed - the video may be private, geo-restricted, or unavailable. Try updating yt-dlp: pip install -U yt-dlp")
-                        raise
+            async def relay_progress(d):
+                nonlocal received, first_byte
+                if d['status'] == 'postprocessing':
+                    if progress_callback:
+                        await progress_callback(0, 100, f"Processing video ({d['postprocessor']})...")
+                    return
+                
+                # Counters restart for every format yt-dlp fetches (video, audio)
+                if d['downloaded_bytes'] < received:
+                    received = 0
+                download_bandwidth.account(share, d['downloaded_bytes'] - received)
+                received = d['downloaded_bytes']
+                if winner is not None and first_byte is None and received:
+                    first_byte = time.monotonic() - winner['started']
+                if not progress_callback:
+                    return
+                
+                total = d['total_bytes']
+                # HLS/DASH often has no size up front, extrapolate from the fragments
+                if not total and d['fragment_index'] and d['fragment_count']:
+                    total = d['downloaded_bytes'] * d['fragment_count'] // d['fragment_index']
+                if total:
+                    await progress_callback(
+                        d['downloaded_bytes'], max(total, d['downloaded_bytes']), "Downloading video...",
+                        speed=d['speed'], eta=d['eta']
+                    )
+            
+            async def timed_progress(current, total, *args, **kwargs):
+                nonlocal first_byte
+                if first_byte is None and current:
+                    first_byte = time.monotonic() - winner['started']
+                if progress_callback:
+                    await progress_callback(current, total, *args, **kwargs)
             
-            filepath, title = await loop.run_in_executor(None, download)
+            # TikTok - race the direct sources against yt-dlp, download the winner once
+            info = None
+            if host_matches(url, TIKTOK_SITE):
+                winner = await self.resolve_tiktok(url, ydl_opts, progress_callback, token)
+                if winner and 'url' in winner:
+                    result, error = await self.download_file(
+                        winner['url'], winner['filename'], timed_progress, share, token,
+                        extra_headers=winner['headers']
+                    )
+                    record_winner(bool(result))
+                    if result:
+                        return result, None
+                    ytdlp_error, winner = winner['ytdlp_error'], None
+                    if ytdlp_error is not None:
+                        raise ytdlp_error
+                    if progress_callback:
+                        await progress_callback(0, 100, "Trying alternative method...")
+                elif winner:
+                    info, from_cache = winner['info'], winner['cached']
+            
+            # Size and format are known before any bytes move - yt-dlp is
+            # only asked again if it did not run in the race
+            if info is None:
+                info, from_cache = await self.probe_ytdlp(url, ydl_opts, progress_callback, token)
+            size = estimate_video_size(info)
+            error = self.check_size(size, "Video") or await self.disk.reserve(token, size, self._space_wait(progress_callback))
+            if error:
+                return None, error
+            
+            # Runs in a worker process, cancelling through the token (or this
+            # task) stops it there
+            try:
+                filepath, title = await ytdlp_pool.run(
+                    download_video, url, ydl_opts, self.download_dir, url_hash, info,
+                    progress=relay_progress, token=token
+                )
+            except yt_dlp.utils.DownloadError:
+                if not from_cache:
+                    raise
+                # Format URLs of a cached probe may have expired - extract again
+                self.video_info.forget(normalize_url(url))
+                filepath, title = await ytdlp_pool.run(
+                    download_video, url, ydl_opts, self.download_dir, url_hash,
+                    progress=relay_progress, token=token
+                )
             
+            record_winner(os.path.exists(filepath))
             if os.path.exists(filepath):
                 return filepath, None
             else:
                 return None, "Failed to download video - file not found after download"
                 
         except yt_dlp.utils.DownloadError as e:
+            record_winner(False)
             error_msg = str(e)
             if 'unable to open for writing' in error_msg and 'File name too long' in error_msg:
                 return None, "Filename too long error - please try again (using shorter filename now)"
             elif 'Unable to extract' in error_msg or 'webpage video data' in error_msg:
                 # For TikTok, suggest alternative solutions
-                if any(domain in url.lower() for domain in ['tiktok.com', 'vm.tiktok.com', 'vt.tiktok.com']):
+                if host_matches(url, TIKTOK_SITE):
                     return None, "❌ TikTok download failed after trying multiple methods.\n\n🔧 Solutions:\n1. Update yt-dlp: pip install -U yt-dlp\n2. Check if video is private/age-restricted\n3. Try copying the link again\n4. Video may be geo-blocked in your region"
                 return None, f"Failed to extract video: {str(e)}"
+            elif 'Requested format is not available' in error_msg:
+                return None, f"No format of this video fits the {format_bytes(Config.MAX_FILE_SIZE)} limit"
             return None, f"yt-dlp download error: {str(e)}"
         except Exception as e:
+            record_winner(False)
             error_msg = str(e)
             if 'TikTok download failed' in error_msg:
                 return None, error_msg
             return None, f"Download error: {str(e)}"
 
-    async def download_torrent(self, magnet_or_file, progress_callback=None):
-        """Download torrent using libtorrent with optimized settings"""
-        ses = None
-        handle = None
+    async def probe_ytdlp(self, url, ydl_opts, progress_callback=None, token=None):
+        """Extract a video's info without downloading, cached per URL - (info, from_cache)"""
+        key = normalize_url(url)
+        info = self.video_info.get(key)
+        if info is not None:
+            return info, True
+        
+        if progress_callback:
+            await progress_callback(0, 100, "Fetching video info...")
+        info = await ytdlp_pool.run(probe_video, url, ydl_opts, token=token)
+        self.video_info.put(key, info)
+        return info, False
+    
+    async def download_torrent(self, magnet_or_file, progress_callback=None, share=None, token=None, on_file_complete=None, select_files=None):
+        """Download torrent on the shared libtorrent session"""
+        torrent = None
+        pipeline = None
+        selected = None  # file indices to fetch, decided once metadata is in
         try:
-            # Setup Session
-            ses = lt.session({'listen_interfaces': '0.0.0.0:6881'})
-            ses.add_dht_router('router.bittorrent.com', 6881)
-            ses.add_dht_router('router.utorrent.com', 6881)
-            ses.add_dht_router('dht.transmissionbt.com', 6881)
-            
-            settings = {
-                'connections_limit': 400,
-                'alert_mask': lt.alert.category_t.error_notification | 
-                             lt.alert.category_t.storage_notification | 
-                             lt.alert.category_t.status_notification
-            }
-            ses.apply_settings(settings)
-
             # Setup Add Parameters
             if magnet_or_file.startswith('magnet:'):
                 p = lt.parse_magnet_uri(magnet_or_file)
@@ -444,38 +1166,42 @@ class Downloader:
                 info = lt.torrent_info(magnet_or_file)
                 p.ti = info
             
-            p.save_path = self.torrent_dir
             p.storage_mode = lt.storage_mode_t.storage_mode_sparse
             p.flags = lt.torrent_flags.auto_managed
 
-            # Add Torrent
-            handle = ses.add_torrent(p)
+            # Add Torrent - someone else fetching the same one finishes first
+            async def wait_turn():
+                if progress_callback:
+                    await progress_callback(0, 100, "Waiting for the same torrent to finish...")
+            torrent = await self.torrents.add_when_free(p, wait_turn)
+            handle = torrent.handle
             
-            # Download Loop
+            # Download Loop - woken by session alerts, the timeout only
+            # keeps the metadata and overall deadlines ticking
             metadata_timeout = 180
             download_timeout = 7200
             start_time = time.time()
             last_progress = -1
-            metadata_received = False
+            last_total = 0
             
-            while not handle.is_seed():
+            while not (pipeline.complete if pipeline else (torrent.finished or torrent.status.is_seeding)):
+                if token is not None and token.cancelled:
+                    raise asyncio.CancelledError()
                 if time.time() - start_time > download_timeout:
                     return None, "Torrent download timed out after 2 hours"
+                if torrent.error:
+                    return None, torrent.error
                 
-                s = handle.status()
-
-                # Process alerts
-                alerts = ses.pop_alerts()
-                for alert in alerts:
-                    if isinstance(alert, lt.torrent_error_alert):
-                        return None, f"Torrent error: {alert.message()}"
-                    if isinstance(alert, lt.metadata_failed_alert):
-                        return None, "Failed to fetch metadata (no peers/dead torrent)"
-                    if isinstance(alert, lt.metadata_received_alert):
-                        metadata_received = True
+                s = torrent.status
+                
+                # Count torrent traffic against the shared budget and cap this
+                # torrent at its fair share while other transfers are busy
+                download_bandwidth.account(share, s.total_download - last_total)
+                last_total = s.total_download
+                handle.set_download_limit(download_bandwidth.limit_for(share))
                 
                 # Progress Reporting
-                if not handle.has_metadata():
+                if torrent.info is None:
                     elapsed = time.time() - start_time
                     if elapsed > metadata_timeout:
                         return None, "Timeout waiting for torrent metadata (3 min)"
@@ -485,72 +1211,355 @@ class Downloader:
                         await progress_callback(0, 100, status_msg)
                 
                 else:
-                    if not metadata_received:
-                        metadata_received = True
-                    
-                    info = handle.get_torrent_info()
-                    total_size = info.total_size()
+                    if selected is None:
+                        picked_at = time.time()
+                        selected = await self._select_torrent_files(torrent, select_files)
+                        # Time spent in the picker doesn't count as download time
+                        start_time += time.time() - picked_at
+                        if not selected:
+                            return None, "No files selected"
+                        
+                        files = torrent.info.files()
+                        total_size = sum(files.file_size(i) for i in selected)
+                        error = self.check_size(total_size, "Torrent")
+                        if error:
+                            return None, error
+                        
+                        if not self.disk.try_reserve(token, total_size):
+                            # Hold the torrent until enough space was released
+                            waited_at = time.time()
+                            handle.unset_flags(lt.torrent_flags.auto_managed)
+                            handle.pause()
+                            try:
+                                error = await self.disk.reserve(token, total_size, self._space_wait(progress_callback))
+                            finally:
+                                if handle.is_valid():
+                                    handle.set_flags(lt.torrent_flags.auto_managed)
+                                    handle.resume()
+                            start_time += time.time() - waited_at
+                            if error:
+                                return None, error
+                        
+                        if on_file_complete and len(selected) > 1:
+                            pipeline = FilePipeline(torrent, torrent.save_path, on_file_complete, selected)
+                            pipeline.start()
+                        continue
                     
-                    if total_size > Config.MAX_FILE_SIZE:
-                        return None, f"Torrent size ({format_bytes(total_size)}) exceeds limit"
+                    if pipeline:
+                        pipeline.update()
                     
-                    progress = s.progress * 100
+                    # File priorities make the wanted counters cover the current window only
+                    done = min(s.total_done, total_size) if pipeline else s.total_wanted_done
+                    progress = done / total_size * 100 if total_size else 100
                     download_rate = s.download_rate / 1024 / 1024
                     
                     if progress_callback and abs(progress - last_progress) >= 1:
                         last_progress = progress
                         status_msg = f"Torrenting | ↓ {download_rate:.1f} MB/s | {s.num_peers} peers | {progress:.1f}%"
-                        await progress_callback(int(s.total_done), total_size, status_msg)
+                        await progress_callback(int(done), total_size, status_msg)
 
-                await asyncio.sleep(1)
+                torrent.changed.clear()
+                try:
+                    await asyncio.wait_for(torrent.changed.wait(), timeout=5)
+                except asyncio.TimeoutError:
+                    pass
 
+            if pipeline:
+                await pipeline.join()
+            
             # Finalize
-            info = handle.get_torrent_info()
+            info = torrent.info or handle.torrent_file()
             name = info.name()
 
-            if info.num_files() == 1:
-                filepath = os.path.join(self.torrent_dir, info.files().file_path(0))
+            if len(selected) == 1:
+                filepath = os.path.join(torrent.save_path, info.files().file_path(selected[0]))
             else:
-                filepath = os.path.join(self.torrent_dir, name)
+                filepath = os.path.join(torrent.save_path, name)
             
             return filepath, None
             
         except Exception as e:
             return None, f"Torrent error: {str(e)}"
         finally:
-            if ses and handle and handle.is_valid():
-                ses.remove_torrent(handle)
+            if pipeline:
+                pipeline.close()
+            if torrent:
+                # A cancelled torrent takes its downloaded pieces with it
+                await self.torrents.remove(torrent, delete_files=token is not None and token.cancelled)
 
-    async def download(self, url_or_file, filename=None, progress_callback=None):
-        """Main download function - auto-detects type"""
+    async def _select_torrent_files(self, torrent, select_files=None):
+        """Decide which files of a torrent to fetch and set their priorities"""
+        files = torrent.info.files()
+        wanted = wanted_files(torrent.info)
+        if select_files is None or len(wanted) < 2:
+            return wanted
+        
+        handle = torrent.handle
+        handle.unset_flags(lt.torrent_flags.auto_managed)
+        handle.pause()
+        try:
+            chosen = await select_files(torrent.info)
+            selected = sorted(i for i in set(chosen or ()) if i in wanted)
+            if selected:
+                priorities = [0] * files.num_files()
+                for i in selected:
+                    priorities[i] = 4
+                handle.prioritize_files(priorities)
+            return selected
+        finally:
+            if handle.is_valid():
+                handle.set_flags(lt.torrent_flags.auto_managed)
+                handle.resume()
+    
+    def cache_key(self, url_or_file):
+        """Stable key identifying the content behind a URL, magnet or .torrent file"""
+        if not url_or_file or not isinstance(url_or_file, str):
+            return None
+        
+        if url_or_file.endswith('.torrent') and os.path.isfile(url_or_file):
+            try:
+                with open(url_or_file, 'rb') as f:
+                    return f"torrent:{hashlib.sha1(f.read()).hexdigest()}"
+            except OSError:
+                return None
+        
+        return normalize_url(url_or_file)
+    
+    async def probe(self, url):
+        """Fetch origin validators (ETag, Last-Modified, size) of a direct link"""
+        if not isinstance(url, str) or await self.resolvers.resolve(url) not in (None, 'http'):
+            return {}
+        
+        session = await self.get_session()
+        timeout = aiohttp.ClientTimeout(total=15, connect=10)
+        
+        # Some origins reject HEAD, a one-byte range GET works nearly everywhere
+        for method, headers in (('HEAD', {}), ('GET', {'Range': 'bytes=0-0'})):
+            try:
+                async with session.request(method, url, headers=headers, timeout=timeout, allow_redirects=True) as response:
+                    if response.status >= 400:
+                        continue
+                    if Config.ROUTE_PROBE and self.resolvers.learn(url, response.headers.get('content-type')) != 'http':
+                        return {}
+                    return {
+                        'etag': response.headers.get('etag', ''),
+                        'last_modified': response.headers.get('last-modified', ''),
+                        'size': get_total_size(response) if method == 'GET' else int(response.headers.get('content-length', 0))
+                    }
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+                continue
+        
+        return None
+    
+    def check_size(self, size, what="File"):
+        """Error message if `size` bytes can't be downloaded, None if they can"""
+        if size > Config.MAX_FILE_SIZE:
+            return f"{what} size ({format_bytes(size)}) exceeds the {format_bytes(Config.MAX_FILE_SIZE)} limit"
+        capacity = self.disk.capacity()
+        if size > capacity:
+            return f"Not enough disk space for {format_bytes(size)} ({format_bytes(capacity)} available)"
+        return None
+    
+    def _space_wait(self, progress_callback):
+        """on_wait for DiskSpace.reserve - tell the requesters why nothing moves"""
+        async def on_wait():
+            if progress_callback:
+                await progress_callback(0, 100, "Waiting for disk space...")
+        return on_wait
+    
+    async def preflight(self, url_or_file, fingerprint=None):
+        """Reject a download whose known size can't fit, before it starts"""
+        handler = await self.route(url_or_file)
+        if handler == 'torrent':
+            info = self.torrents.cached_metadata(url_or_file)
+            if info is None:
+                return None
+            files = info.files()
+            sizes = [files.file_size(i) for i in wanted_files(info)]
+            return self.check_size(min(sizes), "Torrent file") if sizes else None
+        
+        if handler in ('ytdlp', 'dash'):
+            info = self.video_info.get(normalize_url(url_or_file))
+            return self.check_size(estimate_video_size(info), "Video") if info else None
+        
+        if handler == 'http' and fingerprint and fingerprint.get('size'):
+            return self.check_size(fingerprint['size'])
+        return None
+    
+    async def download(self, url_or_file, filename=None, progress_callback=None, user_id=None, cancel_token=None, on_file_complete=None, select_files=None):
+        """Main download function - auto-detects type
+        
+        Identical requests share one transfer and its disk reservation, the
+        file is deleted once every requester called cleanup(); picking or
+        streaming torrent files makes a download personal.
+        """
         
         if not url_or_file:
             return None, "No URL or file provided"
         
-        if isinstance(url_or_file, str) and (url_or_file.startswith('magnet:') or url_or_file.endswith('.torrent')):
-            return await self.download_torrent(url_or_file, progress_callback)
+        shared = on_file_complete is None and select_files is None
+        key = (self.cache_key(url_or_file) or url_or_file, filename)
+        flight = self._inflight.get(key) if shared else None
         
-        video_domains = [
-            'youtube.com', 'youtu.be', 'instagram.com', 'facebook.com', 
-            'twitter.com', 'tiktok.com', 'vimeo.com', 'dailymotion.com',
-            'vt.tiktok.com', 'vm.tiktok.com', 'x.com', 'twitch.tv',
-            'reddit.com', 'streamable.com', 'imgur.com'
-        ]
+        if flight is None:
+            flight = InflightDownload()
+            share = download_bandwidth.register(user_id)
+            self.disk.try_reserve(flight.token, 0)
+            
+            async def progress(current, total, status="Downloading", **details):
+                self.disk.wrote(flight.token, current)
+                await flight.progress(current, total, status, **details)
+            
+            def settle(task):
+                filepath = None
+                if not task.cancelled() and task.exception() is None:
+                    filepath = task.result()[0]
+                if filepath:
+                    self.disk.bind(flight.token, filepath)
+                else:
+                    self.disk.release(flight.token)
+            
+            flight.task = asyncio.create_task(self._download(url_or_file, filename, progress, share, flight.token, on_file_complete, select_files))
+            if shared:
+                self._inflight[key] = flight
+                flight.task.add_done_callback(lambda _: self._inflight.pop(key, None))
+            flight.task.add_done_callback(lambda _: share.close())
+            flight.task.add_done_callback(settle)
+        elif progress_callback and flight.last_progress:
+            await progress_callback(*flight.last_progress)
+        
+        flight.consumers += 1
+        flight.callbacks.append(progress_callback)
+        try:
+            filepath, error = await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            # Last requester gone - nobody needs the transfer anymore
+            if flight.consumers == 1:
+                if cancel_token is not None and cancel_token.cancelled:
+                    flight.token.cancel()
+                flight.task.cancel()
+            raise
+        finally:
+            flight.consumers -= 1
+            if progress_callback in flight.callbacks:
+                flight.callbacks.remove(progress_callback)
+        
+        if filepath:
+            self._refs[filepath] = self._refs.get(filepath, 0) + 1
+        return filepath, error
+    
+    async def route(self, url_or_file):
+        """Download handler for a URL - torrent, hls, dash, ytdlp or http"""
+        return await self.resolvers.resolve(url_or_file) or 'http'
+    
+    def job_kind(self, url_or_file):
+        """Worker pool a download belongs to - torrent, ytdlp or http"""
+        handler = self.resolvers.route(url_or_file)
+        if handler in ('torrent', 'ytdlp'):
+            return handler
+        if handler == 'dash':
+            return 'ytdlp'
+        return 'http'
+    
+    async def _download(self, url_or_file, filename=None, progress_callback=None, share=None, token=None, on_file_complete=None, select_files=None):
+        """Pick the download method for a URL, stream manifest, magnet or .torrent file"""
+        
+        handler = await self.route(url_or_file)
+        if handler == 'torrent':
+            return await self.download_torrent(url_or_file, progress_callback, share, token, on_file_complete, select_files)
         
-        is_video_url = any(domain in url_or_file.lower() for domain in video_domains)
+        if handler == 'hls':
+            # Sites whose streams the native path keeps failing on go straight to yt-dlp
+            site = site_of(url_or_file)
+            if self.strategies.rank(site, ['hls', 'ytdlp'])[0] == 'hls':
+                try:
+                    filepath, error = await self.download_hls(url_or_file, filename, progress_callback, share, token)
+                except UnsupportedManifest as e:
+                    self.strategies.record(site, 'hls', False)
+                    print(f"HLS stream left to yt-dlp: {e}")
+                else:
+                    if not (token and token.cancelled):
+                        self.strategies.record(site, 'hls', filepath)
+                    return filepath, error
+            
+            filepath, error = await self.download_ytdlp(url_or_file, progress_callback, share, token)
+            if not (token and token.cancelled):
+                self.strategies.record(site, 'ytdlp', filepath)
+            return filepath, error
+        
+        # DASH needs adaptation set muxing yt-dlp already does well
+        if handler in ('dash', 'ytdlp'):
+            return await self.download_ytdlp(url_or_file, progress_callback, share, token)
+        else:
+            return await self.download_file(url_or_file, filename, progress_callback, share, token)
+    
+    def prune_partials(self, max_age=None):
+        """Remove resume state that has not been touched for too long"""
+        max_age = Config.PARTIAL_MAX_AGE if max_age is None else max_age
+        cutoff = time.time() - max_age
+        removed = 0
+        
+        for directory in (self.download_dir, self.torrent_dir):
+            for name in os.listdir(directory):
+                path = os.path.join(directory, name)
+                try:
+                    if os.path.getmtime(path) >= cutoff:
+                        continue
+                    if name.endswith(('.part', '.part.json', '.ytdl')) and os.path.isfile(path):
+                        os.remove(path)
+                        removed += 1
+                    elif directory == self.torrent_dir and os.path.isdir(path) and not os.listdir(path):
+                        # Job directory a cancelled torrent's deleted data left
+                        os.rmdir(path)
+                except OSError:
+                    pass
         
-        if is_video_url:
-            return await self.download_ytdlp(url_or_file, progress_callback)
+        removed += self.torrents.prune(max_age)
+        return removed
+    
+    def rename(self, filepath, new_path):
+        """Rename a downloaded file without pulling it from under other requesters"""
+        if self._refs.get(filepath, 0) > 1:
+            try:
+                os.link(filepath, new_path)
+            except OSError:
+                shutil.copy2(filepath, new_path)
+            self._refs[filepath] -= 1
         else:
-            return await self.download_file(url_or_file, filename, progress_callback)
+            os.rename(filepath, new_path)
+            self._refs.pop(filepath, None)
+            self.disk.move(filepath, new_path)
+        
+        self._refs[new_path] = self._refs.get(new_path, 0) + 1
+        return new_path
+    
+    def _remove_empty_dirs(self, directory):
+        """Remove the folders a file picked out of a torrent leaves behind"""
+        root = os.path.abspath(self.torrent_dir)
+        directory = os.path.abspath(directory)
+        while directory.startswith(root + os.sep):
+            try:
+                os.rmdir(directory)
+            except OSError:
+                break
+            directory = os.path.dirname(directory)
     
     def cleanup(self, filepath):
-        """Remove downloaded file or directory"""
+        """Release a downloaded file or directory, removing it once unused"""
+        refs = self._refs.get(filepath, 0)
+        if refs > 1:
+            self._refs[filepath] = refs - 1
+            return True
+        self._refs.pop(filepath, None)
+        self.disk.release(filepath)
+        
         try:
             if os.path.isfile(filepath):
                 os.remove(filepath)
+                self._remove_empty_dirs(os.path.dirname(filepath))
             elif os.path.isdir(filepath):
                 shutil.rmtree(filepath)
+                self._remove_empty_dirs(os.path.dirname(filepath))
             return True
         except Exception as e:
             print(f"Cleanup error: {e}")
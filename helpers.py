@@ -2,7 +2,8 @@ import time
 import asyncio
 import math
 from typing import Optional
-from urllib.parse import urlparse
+from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode
+import re
 
 class Progress:
     """Progress tracker for downloads and uploads with stunning UI - Optimized"""
@@ -16,7 +17,7 @@ class Progress:
         self.last_percentage = -1
         self.last_text = ""  # Cache last message to avoid duplicate edits
         
-    async def progress_callback(self, current, total, status="Downloading"):
+    async def progress_callback(self, current, total, status="Downloading", speed=None, eta=None):
         """Progress callback with beautiful box-style formatting - Optimized"""
         now = time.time()
         
@@ -55,9 +56,13 @@ class Progress:
             self.last_percentage = percentage
             
             # Optimized calculations
-            speed = current / elapsed
+            if speed is None:
+                speed = current / elapsed
             speed_mb = speed / (1024 * 1024)
-            eta_seconds = max(0, (total - current) / speed) if speed > 0 else 0
+            if eta is not None:
+                eta_seconds = max(0, eta)
+            else:
+                eta_seconds = max(0, (total - current) / speed) if speed > 0 else 0
             
             # Format data efficiently
             current_mb = current / (1024 * 1024)
@@ -168,15 +173,6 @@ def humanbytes(size):
     # Use 1 decimal for smaller precision, faster formatting
     return f"{size:.1f} {units[n]}"
 
-async def speed_limiter(chunk_size, speed_limit):
-    """Limit download/upload speed - Optimized"""
-    if speed_limit <= 0:
-        return
-    
-    delay = chunk_size / speed_limit
-    if delay > 0.001:  # Only sleep if delay is meaningful
-        await asyncio.sleep(delay)
-
 def is_url(text):
     """Check if text is a valid URL - Optimized"""
     if not text or not isinstance(text, str):
@@ -366,6 +362,51 @@ def validate_url(url):
     except Exception:
         return False
 
+# Query parameters that only track the referrer and never change the content
+_TRACKING_PARAMS = {
+    'fbclid', 'gclid', 'igshid', 'si', 'feature', 'ref', 'ref_src',
+    'mc_cid', 'mc_eid', 'share_id', 'is_from_webapp', 'sender_device'
+}
+
+_BTIH_RE = re.compile(r'xt=urn:btih:([0-9a-zA-Z]+)')
+
+def normalize_url(url):
+    """Normalize URL so equivalent links map to the same key - Fast"""
+    if not url or not isinstance(url, str):
+        return None
+    
+    url = url.strip()
+    
+    if is_magnet(url):
+        match = _BTIH_RE.search(url)
+        return f"btih:{match.group(1).lower()}" if match else url
+    
+    if url.lower().startswith('www.'):
+        url = f"http://{url}"
+    
+    try:
+        parsed = urlparse(url)
+        port = parsed.port
+    except Exception:
+        return url
+    
+    scheme = parsed.scheme.lower()
+    host = (parsed.hostname or '').lower()
+    if host.startswith('www.'):
+        host = host[4:]
+    
+    if (scheme, port) in (('http', 80), ('https', 443)):
+        port = None
+    netloc = f"{host}:{port}" if port else host
+    
+    query = sorted(
+        (key, value) for key, value in parse_qsl(parsed.query, keep_blank_values=True)
+        if key.lower() not in _TRACKING_PARAMS and not key.lower().startswith('utm_')
+    )
+    
+    path = parsed.path.rstrip('/') or '/'
+    return urlunparse((scheme, netloc, path, '', urlencode(query), ''))
+
 def get_readable_message(current, total, status="Processing"):
     """Get a readable progress message - Optimized"""
     if total <= 0:
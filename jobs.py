@@ -0,0 +1,185 @@
+import asyncio
+import threading
+from collections import OrderedDict, deque
+from config import Config
+
+class QueueFull(Exception):
+    """Raised when no more jobs can be queued"""
+
+class CancelToken:
+    """Thread-safe cancellation flag shared between a job and the code doing its work"""
+
+    def __init__(self):
+        self._event = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self):
+        self._event.set()
+
+class Job:
+    """A unit of work waiting for or running on a worker"""
+
+    def __init__(self, user_id, kind, func, on_position=None, token=None, interrupt=True):
+        self.user_id = user_id
+        self.kind = kind
+        self.func = func
+        self.on_position = on_position
+        self.token = token or CancelToken()
+        self.interrupt = interrupt  # cancel the task too, not just the token
+        self.position = None
+        self.task = None
+        self.done = asyncio.Event()
+
+    @property
+    def running(self):
+        return self.task is not None and not self.task.done()
+
+class JobScheduler:
+    """Bounded job queue with a worker pool per job type, serving users round-robin"""
+
+    def __init__(self, workers, max_queue, max_user_jobs):
+        self.worker_counts = workers
+        self.max_queue = max_queue
+        self.max_user_jobs = max_user_jobs
+        self._queues = {kind: OrderedDict() for kind in workers}  # kind -> user -> deque of jobs
+        self._available = {}
+        self._workers = []
+        self.running = {}  # user_id -> list of running jobs
+
+    def start(self):
+        """Spawn the worker tasks"""
+        if self._workers:
+            return
+        for kind, count in self.worker_counts.items():
+            self._available[kind] = asyncio.Semaphore(0)
+            for _ in range(count):
+                self._workers.append(asyncio.create_task(self._worker(kind)))
+
+    async def stop(self):
+        """Cancel workers and any running jobs"""
+        for jobs in list(self.running.values()):
+            for job in jobs:
+                job.task.cancel()
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    @property
+    def queued(self):
+        return sum(len(jobs) for users in self._queues.values() for jobs in users.values())
+
+    def user_queued(self, user_id):
+        return sum(len(users.get(user_id, ())) for users in self._queues.values())
+
+    def submit(self, user_id, kind, func, on_position=None, token=None, interrupt=True):
+        """Queue `func` (a coroutine function) to run on a `kind` worker"""
+        if self.queued >= self.max_queue:
+            raise QueueFull("The queue is full, please try again in a few minutes")
+        if self.user_queued(user_id) >= self.max_user_jobs:
+            raise QueueFull(f"You already have {self.max_user_jobs} jobs waiting")
+
+        job = Job(user_id, kind, func, on_position, token, interrupt)
+        self._queues[kind].setdefault(user_id, deque()).append(job)
+        self._update_positions(kind)
+        self._available[kind].release()
+        return job
+
+    def cancel_user(self, user_id):
+        """Drop a user's waiting jobs and stop the running ones, returning them"""
+        cancelled = []
+        for kind, users in self._queues.items():
+            jobs = users.pop(user_id, None)
+            if jobs:
+                cancelled.extend(jobs)
+                self._update_positions(kind)
+        for job in cancelled:
+            job.token.cancel()
+            job.done.set()
+
+        for job in self.running.get(user_id, []):
+            job.token.cancel()
+            if job.interrupt:
+                job.task.cancel()
+            cancelled.append(job)
+        return cancelled
+
+    def withdraw(self, job):
+        """Take a job out of the queue before it started, True if it was waiting"""
+        jobs = self._queues[job.kind].get(job.user_id)
+        if not jobs or job not in jobs:
+            return False
+        jobs.remove(job)
+        if not jobs:
+            del self._queues[job.kind][job.user_id]
+        self._update_positions(job.kind)
+        job.token.cancel()
+        job.done.set()
+        return True
+
+    def _order(self, kind):
+        """Waiting jobs in the order they will be dispatched"""
+        users = [list(jobs) for jobs in self._queues[kind].values()]
+        order = []
+        for round_ in range(max((len(jobs) for jobs in users), default=0)):
+            order.extend(jobs[round_] for jobs in users if round_ < len(jobs))
+        return order
+
+    def _update_positions(self, kind):
+        for position, job in enumerate(self._order(kind), start=1):
+            if job.position != position:
+                job.position = position
+                if job.on_position:
+                    asyncio.create_task(self._report(job, position))
+
+    async def _report(self, job, position):
+        try:
+            await job.on_position(position)
+        except Exception as e:
+            print(f"Queue position update error: {e}")
+
+    def _pop(self, kind):
+        """Take the next job, rotating the user to the back of the line"""
+        users = self._queues[kind]
+        user_id, jobs = next(iter(users.items()))
+        job = jobs.popleft()
+        if jobs:
+            users.move_to_end(user_id)
+        else:
+            del users[user_id]
+        return job
+
+    async def _worker(self, kind):
+        while True:
+            await self._available[kind].acquire()
+            if not self._queues[kind]:
+                continue
+            job = self._pop(kind)
+            job.position = 0
+            self._update_positions(kind)
+
+            job.task = asyncio.create_task(job.func())
+            self.running.setdefault(job.user_id, []).append(job)
+            try:
+                await asyncio.wait([job.task])
+                if not job.task.cancelled() and job.task.exception():
+                    print(f"Job error ({kind}) for user {job.user_id}: {job.task.exception()}")
+            finally:
+                self.running[job.user_id].remove(job)
+                if not self.running[job.user_id]:
+                    del self.running[job.user_id]
+                job.done.set()
+
+scheduler = JobScheduler(
+    workers={
+        'http': Config.HTTP_WORKERS,
+        'ytdlp': Config.YTDLP_WORKERS,
+        'torrent': Config.TORRENT_WORKERS,
+        'upload': Config.UPLOAD_WORKERS,
+    },
+    max_queue=Config.MAX_QUEUE_SIZE,
+    max_user_jobs=Config.MAX_USER_JOBS
+)
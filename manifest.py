@@ -0,0 +1,140 @@
+import re
+from urllib.parse import urljoin, urlparse
+
+# key=value pairs of an HLS tag, values optionally quoted
+_ATTR_RE = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
+
+class UnsupportedManifest(Exception):
+    """A stream the built-in downloader can't handle - yt-dlp has to"""
+
+def manifest_type(url):
+    """'hls' or 'dash' for links to a stream manifest, else None"""
+    if not isinstance(url, str):
+        return None
+    path = urlparse(url).path.lower()
+    if path.endswith('.m3u8'):
+        return 'hls'
+    if path.endswith('.mpd'):
+        return 'dash'
+    return None
+
+def parse_attributes(text):
+    return {key: value.strip('"') for key, value in _ATTR_RE.findall(text)}
+
+class Variant:
+    """One rendition listed in an HLS master playlist"""
+
+    def __init__(self, url, bandwidth=0, resolution=None, audio_group=None):
+        self.url = url
+        self.bandwidth = bandwidth  # bits per second, audio included
+        self.resolution = resolution
+        self.audio_group = audio_group
+
+class MediaSegment:
+    """A piece of a media playlist, optionally a byte range of its URL"""
+
+    def __init__(self, url, duration=0.0, byte_range=None):
+        self.url = url
+        self.duration = duration
+        self.byte_range = byte_range  # (start, end) inclusive
+
+    @property
+    def headers(self):
+        if self.byte_range is None:
+            return {}
+        return {'Range': f"bytes={self.byte_range[0]}-{self.byte_range[1]}"}
+
+class MasterPlaylist:
+    def __init__(self, variants, audio):
+        self.variants = variants
+        self.audio = audio  # audio group id -> URL of its default rendition
+
+    def pick(self, duration, max_size):
+        """Best variant whose estimated size fits max_size, None if none does"""
+        ranked = sorted(self.variants, key=lambda v: v.bandwidth, reverse=True)
+        for variant in ranked:
+            if variant.bandwidth and variant.bandwidth / 8 * duration <= max_size:
+                return variant
+        if ranked and not any(v.bandwidth for v in ranked):
+            return ranked[0]
+        return None
+
+class MediaPlaylist:
+    def __init__(self, segments, init=None):
+        self.segments = segments
+        self.init = init  # EXT-X-MAP segment of fragmented MP4 streams
+
+    @property
+    def duration(self):
+        return sum(segment.duration for segment in self.segments)
+
+def parse_byte_range(value, previous_end):
+    """EXT-X-BYTERANGE 'length[@offset]' to an inclusive range"""
+    length, _, offset = value.partition('@')
+    start = int(offset) if offset else previous_end + 1
+    return start, start + int(length) - 1
+
+def parse_hls(text, base_url):
+    """Parse an HLS playlist into a MasterPlaylist or MediaPlaylist"""
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+    if not lines or not lines[0].startswith('#EXTM3U'):
+        raise UnsupportedManifest("Not an HLS playlist")
+
+    if any(line.startswith('#EXT-X-STREAM-INF') for line in lines):
+        variants = []
+        audio = {}
+        pending = None
+        for line in lines:
+            if line.startswith('#EXT-X-STREAM-INF:'):
+                pending = parse_attributes(line.split(':', 1)[1])
+            elif line.startswith('#EXT-X-MEDIA:'):
+                attrs = parse_attributes(line.split(':', 1)[1])
+                if attrs.get('TYPE') == 'AUDIO' and attrs.get('URI'):
+                    group = attrs.get('GROUP-ID')
+                    if group not in audio or attrs.get('DEFAULT') == 'YES':
+                        audio[group] = urljoin(base_url, attrs['URI'])
+            elif not line.startswith('#') and pending is not None:
+                variants.append(Variant(
+                    urljoin(base_url, line),
+                    int(pending.get('BANDWIDTH', 0) or 0),
+                    pending.get('RESOLUTION'),
+                    pending.get('AUDIO')
+                ))
+                pending = None
+        return MasterPlaylist(variants, audio)
+
+    segments = []
+    init = None
+    duration = 0.0
+    byte_range = None
+    last_end = -1
+    ended = False
+    for line in lines:
+        if line.startswith('#EXTINF:'):
+            duration = float(line.split(':', 1)[1].split(',')[0] or 0)
+        elif line.startswith('#EXT-X-BYTERANGE:'):
+            byte_range = parse_byte_range(line.split(':', 1)[1], last_end)
+        elif line.startswith('#EXT-X-KEY:'):
+            method = parse_attributes(line.split(':', 1)[1]).get('METHOD', 'NONE')
+            if method != 'NONE':
+                raise UnsupportedManifest(f"Encrypted stream ({method})")
+        elif line.startswith('#EXT-X-MAP:'):
+            attrs = parse_attributes(line.split(':', 1)[1])
+            map_range = None
+            if attrs.get('BYTERANGE'):
+                map_range = parse_byte_range(attrs['BYTERANGE'], -1)
+            init = MediaSegment(urljoin(base_url, attrs['URI']), byte_range=map_range)
+        elif line.startswith('#EXT-X-ENDLIST'):
+            ended = True
+        elif not line.startswith('#'):
+            segments.append(MediaSegment(urljoin(base_url, line), duration, byte_range))
+            if byte_range:
+                last_end = byte_range[1]
+            duration = 0.0
+            byte_range = None
+
+    if not ended:
+        raise UnsupportedManifest("Live stream")
+    if not segments:
+        raise UnsupportedManifest("Empty playlist")
+    return MediaPlaylist(segments, init)
@@ -0,0 +1,164 @@
+import os
+import time
+import asyncio
+import yt_dlp
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from urllib.parse import urlparse
+from manifest import manifest_type
+from helpers import normalize_url
+
+# Sites handled by yt-dlp instead of a plain HTTP download, subdomains included
+VIDEO_DOMAINS = [
+    'youtube.com', 'youtu.be', 'instagram.com', 'facebook.com', 'fb.watch',
+    'twitter.com', 'x.com', 'tiktok.com', 'vimeo.com', 'dailymotion.com',
+    'twitch.tv', 'reddit.com', 'redd.it', 'streamable.com', 'imgur.com',
+    'soundcloud.com', 'bilibili.com', 'pinterest.com', 'pin.it', 'vk.com'
+]
+
+# Content types of pages that embed a video rather than being the file
+PAGE_TYPES = ('text/html', 'application/xhtml+xml')
+
+def host_of(url):
+    """Lower-case host of a URL, '' if it has none"""
+    if not isinstance(url, str):
+        return ''
+    return (urlparse(url.strip()).hostname or '').lower()
+
+def host_matches(url, domains):
+    """Whether a URL's host is one of the domains or a subdomain of one"""
+    if isinstance(domains, str):
+        domains = (domains,)
+    host = host_of(url)
+    return any(host == domain or host.endswith('.' + domain) for domain in domains)
+
+class Resolver(ABC):
+    """Claims URLs for a download handler, `blocking` ones run in an executor"""
+
+    blocking = False
+
+    @abstractmethod
+    def resolve(self, url, host):
+        """'torrent', 'hls', 'dash', 'ytdlp' or 'http', None to pass the URL on"""
+
+class TorrentResolver(Resolver):
+    def resolve(self, url, host):
+        if url.startswith('magnet:') or url.endswith('.torrent'):
+            return 'torrent'
+        return None
+
+class ManifestResolver(Resolver):
+    def resolve(self, url, host):
+        return manifest_type(url)
+
+class DomainResolver(Resolver):
+    """Sends every URL of the given sites and their subdomains to one handler"""
+
+    def __init__(self, handler, domains):
+        self.handler = handler
+        self.domains = tuple(domains)
+
+    def resolve(self, url, host):
+        if any(host == domain or host.endswith('.' + domain) for domain in self.domains):
+            return self.handler
+        return None
+
+class ExtractorResolver(Resolver):
+    """Sends URLs a dedicated yt-dlp extractor claims to yt-dlp"""
+
+    blocking = True
+
+    def __init__(self):
+        self._extractors = None
+
+    def resolve(self, url, host):
+        if self._extractors is None:
+            self._extractors = [
+                ie for ie in yt_dlp.extractor.gen_extractor_classes()
+                if ie.ie_key() != 'Generic' and ie.working()
+            ]
+        if any(ie.suitable(url) for ie in self._extractors):
+            return 'ytdlp'
+        return None
+
+class ResolverRegistry:
+    """Routes URLs to download handlers through the registered resolvers"""
+
+    def __init__(self, max_hosts=4096, learn_ttl=3600):
+        self.resolvers = []
+        self.max_hosts = max_hosts
+        self.learn_ttl = learn_ttl
+        self.decisions = OrderedDict()  # normalized URL or (host, extension) -> (handler, expiry or None)
+
+    def register(self, resolver, first=False):
+        if first:
+            self.resolvers.insert(0, resolver)
+        else:
+            self.resolvers.append(resolver)
+
+    def _cached(self, key):
+        entry = self.decisions.get(key)
+        if entry is None:
+            return None
+        handler, expiry = entry
+        if expiry is not None and time.monotonic() >= expiry:
+            del self.decisions[key]
+            return None
+        self.decisions.move_to_end(key)
+        return handler
+
+    def _remember(self, key, handler, ttl=None):
+        self.decisions[key] = handler, time.monotonic() + ttl if ttl is not None else None
+        self.decisions.move_to_end(key)
+        while len(self.decisions) > self.max_hosts:
+            self.decisions.popitem(last=False)
+
+    def _key(self, url):
+        return host_of(url), os.path.splitext(urlparse(url).path)[1].lower()
+
+    def route(self, url):
+        """Handler for a URL from the cheap resolvers and the cache, None if undecided"""
+        if not isinstance(url, str):
+            return None
+        url = url.strip()
+        host = host_of(url)
+
+        for resolver in self.resolvers:
+            if resolver.blocking:
+                continue
+            handler = resolver.resolve(url, host)
+            if handler:
+                return handler
+
+        return self._cached(normalize_url(url)) or self._cached(self._key(url))
+
+    def _ask_blocking(self, url, host):
+        for resolver in self.resolvers:
+            if resolver.blocking:
+                handler = resolver.resolve(url, host)
+                if handler:
+                    return handler
+        return None
+
+    async def resolve(self, url):
+        """Handler for a URL, asking the slow resolvers off the event loop if needed"""
+        handler = self.route(url)
+        if handler is not None or not isinstance(url, str):
+            return handler
+
+        url = url.strip()
+        host = host_of(url)
+        loop = asyncio.get_running_loop()
+        handler = await loop.run_in_executor(None, self._ask_blocking, url, host)
+        if handler:
+            # Extractors claim some paths of a site only, never the whole host
+            self._remember(normalize_url(url), handler)
+        return handler
+
+    def learn(self, url, content_type):
+        """Route a host and file extension by a probe's content type - pages to yt-dlp"""
+        content_type = (content_type or '').split(';')[0].strip().lower()
+        handler = 'ytdlp' if content_type in PAGE_TYPES else 'http'
+        if self.learn_ttl:
+            self._remember(self._key(url), handler, self.learn_ttl)
+        return handler
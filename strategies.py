@@ -0,0 +1,102 @@
+import os
+import json
+import time
+import random
+import statistics
+from collections import deque
+from urllib.parse import urlparse
+from config import Config
+
+def site_of(url):
+    """Host a URL points at, without the www. prefix"""
+    host = (urlparse(url).hostname or '') if isinstance(url, str) else ''
+    return host[4:] if host.startswith('www.') else host
+
+class StrategyStats:
+    """Rolling record of how well each way of fetching a site works"""
+
+    def __init__(self, path):
+        self.path = path
+        self.outcomes = {}  # (site, strategy) -> deque of (ok, seconds or None, timestamp)
+        self._last_save = 0
+        self._dirty = False
+        self._load()
+
+    def _window(self, site, strategy):
+        key = (site, strategy)
+        if key not in self.outcomes:
+            self.outcomes[key] = deque(maxlen=Config.STRATEGY_WINDOW)
+        window = self.outcomes[key]
+        cutoff = time.time() - Config.STRATEGY_MAX_AGE
+        while window and window[0][2] < cutoff:
+            window.popleft()
+        return window
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+
+        for site, strategies in data.items():
+            for strategy, outcomes in strategies.items():
+                window = self._window(site, strategy)
+                window.extend(tuple(outcome) for outcome in outcomes)
+
+    def save(self):
+        if not self._dirty:
+            return
+        data = {}
+        for (site, strategy), window in self.outcomes.items():
+            if window:
+                data.setdefault(site, {})[strategy] = list(window)
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"Strategy stats save error: {e}")
+            return
+        self._dirty = False
+        self._last_save = time.monotonic()
+
+    def record(self, site, strategy, ok, seconds=None):
+        """Add an attempt's outcome; seconds only for successful attempts"""
+        self._window(site, strategy).append((bool(ok), seconds if ok else None, time.time()))
+        self._dirty = True
+        if time.monotonic() - self._last_save >= Config.STRATEGY_SAVE_INTERVAL:
+            self.save()
+
+    def _summary(self, site, strategy):
+        """(attempts, successes, median seconds to media or None)"""
+        window = self._window(site, strategy)
+        successes = [seconds for ok, seconds, _ in window if ok]
+        timings = [seconds for seconds in successes if seconds is not None]
+        return len(window), len(successes), statistics.median(timings) if timings else None
+
+    def rank(self, site, strategies):
+        """Order strategies by expected time to a working result, dropping dead ones"""
+        summaries = {strategy: self._summary(site, strategy) for strategy in strategies}
+        timings = [timing for _, _, timing in summaries.values() if timing is not None]
+        typical = statistics.median(timings) if timings else 1.0
+
+        def cost(strategy):
+            attempts, successes, timing = summaries[strategy]
+            rate = (successes + 1) / (attempts + 2)
+            return (timing if timing is not None else typical) / rate
+
+        def dead(strategy):
+            attempts, successes, _ = summaries[strategy]
+            return attempts >= Config.STRATEGY_MIN_SAMPLES and successes / attempts < Config.STRATEGY_MIN_SUCCESS
+
+        ranked = sorted(strategies, key=cost)
+        alive = [strategy for strategy in ranked if not dead(strategy)]
+        if not alive:
+            return ranked
+        retried = [strategy for strategy in ranked if dead(strategy) and random.random() < Config.STRATEGY_EXPLORE]
+        return alive + retried
+
+    def measured(self, site, strategy):
+        return self._summary(site, strategy)[0] > 0
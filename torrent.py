@@ -0,0 +1,496 @@
+import os
+import time
+import shutil
+import asyncio
+import tempfile
+import threading
+import libtorrent as lt
+from config import Config
+
+# DHT bootstrap nodes, only needed the first time the session starts
+DHT_ROUTERS = [
+    ('router.bittorrent.com', 6881),
+    ('router.utorrent.com', 6881),
+    ('dht.transmissionbt.com', 6881),
+]
+
+def profile_settings(name=None):
+    """libtorrent settings of a Config.TORRENT_PROFILES profile this build knows"""
+    name = name or Config.TORRENT_PROFILE
+    if name not in Config.TORRENT_PROFILES:
+        print(f"Unknown torrent profile '{name}', using libtorrent defaults")
+        return {}
+
+    known = lt.default_settings()
+    settings = {}
+    for key, value in Config.TORRENT_PROFILES[name].items():
+        if key in known:
+            settings[key] = value
+        else:
+            print(f"Torrent profile '{name}': libtorrent has no setting '{key}'")
+    return settings
+
+def write_atomic(path, data):
+    """Replace a file's content without leaving a torn file behind"""
+    tmp_path = path + '.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Could not save torrent state: {e}")
+
+def wanted_files(info):
+    """Indices of a torrent's real files - pad files only exist to align pieces"""
+    files = info.files()
+    return [i for i in range(files.num_files()) if not files.file_flags(i) & lt.file_storage.flag_pad_file]
+
+class TorrentJob:
+    """A torrent added to the shared session, kept up to date from its alerts"""
+
+    def __init__(self, key, handle, save_path):
+        self.key = key
+        self.handle = handle
+        self.save_path = save_path
+        self.status = handle.status()
+        self.metadata_received = self.status.has_metadata
+        self.info = handle.torrent_file() if self.metadata_received else None
+        self.error = None
+        self.finished = False
+        self.saving = False  # resume data requested, alert not seen yet
+        self.removed = False
+        self.changed = asyncio.Event()
+        self.gone = asyncio.Event()  # set once removed from the session
+
+class TorrentSession:
+    """One long-lived libtorrent session shared by every torrent download"""
+
+    def __init__(self, save_path, state_path):
+        self.save_path = save_path
+        self.session_file = os.path.join(state_path, 'session.dat')
+        self.resume_dir = os.path.join(state_path, 'resume')
+        self.metadata_dir = os.path.join(state_path, 'metadata')
+        self.session = None
+        self.jobs = {}  # v1 info-hash -> TorrentJob
+        self._handles = {}  # torrent_handle -> TorrentJob, for routing alerts
+        self._loop = None
+        self._monitor_thread = None
+        self._stopping = threading.Event()
+
+        os.makedirs(self.resume_dir, exist_ok=True)
+        os.makedirs(self.metadata_dir, exist_ok=True)
+
+    def start(self):
+        """Create the session on first use, restoring the saved DHT state"""
+        if self.session is not None:
+            return self.session
+
+        settings = {
+            'connections_limit': 400,
+            **profile_settings(),
+            'listen_interfaces': '0.0.0.0:6881',
+            'close_redundant_connections': False,
+            'download_rate_limit': max(0, Config.SPEED_LIMIT),
+            'alert_mask': lt.alert.category_t.error_notification |
+                          lt.alert.category_t.storage_notification |
+                          lt.alert.category_t.status_notification
+        }
+
+        params = None
+        try:
+            with open(self.session_file, 'rb') as f:
+                params = lt.read_session_params(f.read(), lt.save_state_flags_t.save_dht_state)
+        except (OSError, RuntimeError) as e:
+            if not isinstance(e, FileNotFoundError):
+                print(f"Could not load torrent session state: {e}")
+
+        if params is not None:
+            self.session = lt.session(params)
+            self.session.apply_settings(settings)
+        else:
+            self.session = lt.session(settings)
+        for host, port in DHT_ROUTERS:
+            self.session.add_dht_router(host, port)
+
+        self._loop = asyncio.get_running_loop()
+        self._stopping.clear()
+        self._monitor_thread = threading.Thread(target=self._monitor, args=(self.session,), name="torrent-alerts", daemon=True)
+        self._monitor_thread.start()
+        return self.session
+
+    async def stop(self):
+        """Save resume data and session state, then shut the session down"""
+        if self.session is None:
+            return
+        await self._save_resume(list(self.jobs.values()))
+        self._stopping.set()
+        await self._loop.run_in_executor(None, self._monitor_thread.join)
+        self.save_state()
+        for job in list(self.jobs.values()):
+            job.removed = True
+            if job.handle.is_valid():
+                self.session.remove_torrent(job.handle)
+            job.gone.set()
+        self.jobs.clear()
+        self._handles.clear()
+        self.session = None
+
+    def _resume_path(self, key):
+        return os.path.join(self.resume_dir, f"{key}.fastresume")
+
+    def _metadata_path(self, key):
+        return os.path.join(self.metadata_dir, f"{key}.torrent")
+
+    def add(self, params):
+        """Add a torrent with its cached metadata and resume data, returning its TorrentJob"""
+        session = self.start()
+
+        key = self._key(params)
+        if key in self.jobs:
+            raise ValueError("This torrent is already being downloaded")
+
+        if params.ti is None and os.path.exists(self._metadata_path(key)):
+            try:
+                params.ti = lt.torrent_info(self._metadata_path(key))
+            except RuntimeError:
+                pass
+
+        try:
+            with open(self._resume_path(key), 'rb') as f:
+                resume = lt.read_resume_data(f.read())
+            # An interrupted job continues in the directory holding its pieces
+            if not (self._is_job_dir(resume.save_path) and os.path.isdir(resume.save_path)):
+                resume.save_path = params.save_path
+            resume.storage_mode = params.storage_mode
+            resume.flags = params.flags
+            if resume.ti is None:
+                resume.ti = params.ti
+            params = resume
+        except (OSError, RuntimeError):
+            pass
+
+        # Every job gets its own directory, deleting a cancelled one's data
+        # can't touch files another job still hands off
+        params.save_path = params.save_path or tempfile.mkdtemp(prefix=f"{key[:16]}-", dir=self.save_path)
+        job = TorrentJob(key, session.add_torrent(params), params.save_path)
+        self.jobs[key] = job
+        self._handles[job.handle] = job
+        return job
+
+    def _is_job_dir(self, path):
+        return bool(path) and os.path.dirname(os.path.abspath(path)) == os.path.abspath(self.save_path)
+
+    def _key(self, params):
+        return str(params.ti.info_hashes().v1 if params.ti else params.info_hashes.v1)
+
+    async def add_when_free(self, params, on_wait=None):
+        """add() once no other job downloads the same torrent, awaiting `on_wait` if it waits"""
+        key = self._key(params)
+        while key in self.jobs:
+            if on_wait:
+                await on_wait()
+                on_wait = None
+            await self.jobs[key].gone.wait()
+        return self.add(params)
+
+    def cached_metadata(self, magnet_or_file):
+        """torrent_info of a .torrent file or of a magnet fetched before, None if not known yet"""
+        if magnet_or_file.startswith('magnet:'):
+            try:
+                key = str(lt.parse_magnet_uri(magnet_or_file).info_hashes.v1)
+            except RuntimeError:
+                return None
+            path = self._metadata_path(key)
+        else:
+            path = magnet_or_file
+        if not os.path.isfile(path):
+            return None
+        try:
+            return lt.torrent_info(path)
+        except RuntimeError:
+            return None
+
+    async def remove(self, job, delete_files=False):
+        """Drop a torrent from the session, keeping resume data only while it is unfinished"""
+        if job.removed:
+            return
+        job.removed = True
+
+        if self.session is not None and job.handle.is_valid():
+            finished = job.finished or job.handle.status().is_finished
+            if delete_files or finished:
+                self._discard_resume(job.key)
+            else:
+                await self._save_resume([job])
+            if delete_files:
+                flags = lt.session.delete_files
+            elif finished:
+                # The part file only holds pieces of deselected or handed-off files
+                flags = lt.session.delete_partfile
+            else:
+                flags = 0
+            self.session.remove_torrent(job.handle, flags)
+        self.jobs.pop(job.key, None)
+        self._handles.pop(job.handle, None)
+        job.gone.set()
+
+    def _discard_resume(self, key):
+        try:
+            os.remove(self._resume_path(key))
+        except OSError:
+            pass
+
+    def _request_resume(self, jobs):
+        """Ask libtorrent for resume data of jobs that changed since the last save"""
+        requested = []
+        for job in jobs:
+            if not job.saving and job.handle.is_valid() and job.handle.need_save_resume_data():
+                job.saving = True
+                job.handle.save_resume_data(lt.torrent_handle.save_info_dict)
+                requested.append(job)
+        return requested
+
+    async def _save_resume(self, jobs, timeout=10):
+        """Write resume data for jobs and wait until it is on disk"""
+        requested = self._request_resume(jobs)
+        deadline = time.monotonic() + timeout
+        while any(job.saving for job in requested) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+
+    def save_state(self):
+        """Persist the DHT routing table"""
+        if self.session is None:
+            return
+        state = self.session.session_state(lt.save_state_flags_t.save_dht_state)
+        write_atomic(self.session_file, lt.write_session_params_buf(state, lt.save_state_flags_t.save_dht_state))
+
+    def checkpoint(self):
+        """Periodic save of session state and changed resume data"""
+        self._request_resume(list(self.jobs.values()))
+        self.save_state()
+
+    def _monitor(self, session):
+        """Alert thread - blocks until libtorrent has something to report"""
+        next_update = time.monotonic()
+        next_checkpoint = next_update + Config.TORRENT_SAVE_INTERVAL
+        while not self._stopping.is_set():
+            now = time.monotonic()
+            if now >= next_update:
+                session.post_torrent_updates()
+                next_update = now + Config.TORRENT_UPDATE_INTERVAL
+            if now >= next_checkpoint:
+                self._loop.call_soon_threadsafe(self.checkpoint)
+                next_checkpoint = now + Config.TORRENT_SAVE_INTERVAL
+
+            if session.wait_for_alert(int((next_update - now) * 1000) + 1) is None:
+                continue
+
+            events = []
+            for alert in session.pop_alerts():
+                if isinstance(alert, lt.state_update_alert):
+                    events.extend(('status', status.handle, status) for status in alert.status)
+                elif isinstance(alert, lt.save_resume_data_alert):
+                    events.append(('resume', alert.handle, lt.write_resume_data_buf(alert.params)))
+                elif isinstance(alert, lt.save_resume_data_failed_alert):
+                    events.append(('resume', alert.handle, None))
+                elif isinstance(alert, lt.torrent_error_alert):
+                    events.append(('error', alert.handle, f"Torrent error: {alert.message()}"))
+                elif isinstance(alert, lt.metadata_failed_alert):
+                    events.append(('error', alert.handle, "Failed to fetch metadata (no peers/dead torrent)"))
+                elif isinstance(alert, lt.metadata_received_alert):
+                    events.append(('metadata', alert.handle, None))
+                elif isinstance(alert, lt.torrent_finished_alert):
+                    events.append(('finished', alert.handle, None))
+            if events:
+                self._loop.call_soon_threadsafe(self._dispatch, events)
+
+    def _dispatch(self, events):
+        """Apply alert events on the loop and wake the affected downloads"""
+        for kind, handle, value in events:
+            job = self._handles.get(handle)
+            if job is None:
+                continue
+
+            if kind == 'status':
+                job.status = value
+            elif kind == 'resume':
+                job.saving = False
+                if value is not None:
+                    write_atomic(self._resume_path(job.key), value)
+            elif kind == 'error':
+                job.error = value
+            elif kind == 'metadata':
+                job.metadata_received = True
+                job.info = job.handle.torrent_file()
+                self._save_metadata(job)
+            elif kind == 'finished':
+                job.finished = True
+            job.changed.set()
+
+    def _save_metadata(self, job):
+        """Cache a magnet's metadata so it never has to be fetched again"""
+        if job.info is not None:
+            write_atomic(self._metadata_path(job.key), lt.bencode(lt.create_torrent(job.info).generate()))
+
+    def prune(self, max_age):
+        """Delete resume state and data of torrents abandoned for too long"""
+        cutoff = time.time() - max_age
+        removed = 0
+        for name in os.listdir(self.resume_dir):
+            key = name.split('.')[0]
+            path = os.path.join(self.resume_dir, name)
+            try:
+                if key in self.jobs or os.path.getmtime(path) >= cutoff:
+                    continue
+                with open(path, 'rb') as f:
+                    params = lt.read_resume_data(f.read())
+                torrent_name = params.ti.name() if params.ti else params.name
+                if self._is_job_dir(params.save_path):
+                    shutil.rmtree(params.save_path, ignore_errors=True)
+                elif torrent_name:
+                    data_path = os.path.join(self.save_path, torrent_name)
+                    if os.path.isdir(data_path):
+                        shutil.rmtree(data_path)
+                    elif os.path.exists(data_path):
+                        os.remove(data_path)
+                os.remove(path)
+                removed += 1
+            except (OSError, RuntimeError):
+                pass
+        return removed
+
+class FilePipeline:
+    """Download a multi-file torrent a few files at a time, handing each finished one off"""
+
+    def __init__(self, job, save_path, on_file_complete, indices, window=2):
+        self.job = job
+        self.on_file_complete = on_file_complete
+        self.window = window
+
+        files = job.info.files()
+        self.sizes = {i: files.file_size(i) for i in range(files.num_files())}
+        self.paths = {i: os.path.join(save_path, files.file_path(i)) for i in self.sizes}
+        self.order = list(indices)
+        self.active = []
+        self.sent = []
+        self.backlog = 0  # finished files waiting for or in their handoff
+        self._next = 0
+        self._queue = asyncio.Queue()
+        self._handoff = None
+
+    @property
+    def complete(self):
+        return self._next == len(self.order) and not self.active
+
+    def start(self):
+        self.job.handle.prioritize_files([0] * len(self.sizes))
+        self._handoff = asyncio.create_task(self._run_handoff())
+        self._fill()
+
+    def _fill(self):
+        while (self._next < len(self.order) and len(self.active) < self.window and
+               self.backlog + len(self.active) < self.window):
+            index = self.order[self._next]
+            self._next += 1
+            self.active.append(index)
+        # The oldest file in the window gets the bandwidth, the next one
+        # only picks up spare pieces
+        for rank, index in enumerate(self.active):
+            self.job.handle.file_priority(index, 7 if rank == 0 else 1)
+
+    def update(self):
+        """Pass on files that finished since the last status update"""
+        progress = self.job.handle.file_progress(lt.torrent_handle.piece_granularity)
+        for index in list(self.active):
+            if progress[index] >= self.sizes[index]:
+                self.active.remove(index)
+                # Never fetch it again, even if a recheck finds it deleted
+                self.job.handle.file_priority(index, 0)
+                self.backlog += 1
+                self._queue.put_nowait(index)
+        self._fill()
+
+    async def _run_handoff(self):
+        while True:
+            index = await self._queue.get()
+            path = self.paths[index]
+            try:
+                await self.on_file_complete(path)
+                self.sent.append(path)
+            except Exception as e:
+                print(f"Torrent file handoff error: {e}")
+            finally:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                self.backlog -= 1
+                self._queue.task_done()
+                self._fill()
+
+    async def join(self):
+        """Wait until every finished file has been handed off"""
+        await self._queue.join()
+        self.close()
+
+    def close(self):
+        if self._handoff is not None:
+            self._handoff.cancel()
+            self._handoff = None
+
+def benchmark(profile=None, size=512 * 1024 * 1024, timeout=300):
+    """Bytes per second a profile reaches downloading from a local seeder"""
+    workdir = tempfile.mkdtemp(prefix='torrent-bench-')
+    seed_dir = os.path.join(workdir, 'seed')
+    leech_dir = os.path.join(workdir, 'leech')
+    os.makedirs(seed_dir)
+    os.makedirs(leech_dir)
+    try:
+        with open(os.path.join(seed_dir, 'payload.bin'), 'wb') as f:
+            for _ in range(0, size, 4 * 1024 * 1024):
+                f.write(os.urandom(4 * 1024 * 1024))
+
+        storage = lt.file_storage()
+        lt.add_files(storage, os.path.join(seed_dir, 'payload.bin'))
+        creator = lt.create_torrent(storage)
+        lt.set_piece_hashes(creator, seed_dir)
+        info = lt.torrent_info(creator.generate())
+
+        settings = {
+            **profile_settings(profile),
+            'listen_interfaces': '127.0.0.1:0',
+            'enable_dht': False,
+            'enable_lsd': False,
+            'enable_upnp': False,
+            'enable_natpmp': False,
+        }
+        seeder = lt.session(settings)
+        leecher = lt.session(settings)
+
+        params = lt.add_torrent_params()
+        params.ti = info
+        params.save_path = seed_dir
+        params.flags |= lt.torrent_flags.seed_mode
+        seeder.add_torrent(params)
+
+        params = lt.add_torrent_params()
+        params.ti = lt.torrent_info(info)
+        params.save_path = leech_dir
+        handle = leecher.add_torrent(params)
+        handle.connect_peer(('127.0.0.1', seeder.listen_port()))
+
+        start = time.monotonic()
+        while not handle.status().is_seeding:
+            if time.monotonic() - start > timeout:
+                raise TimeoutError(f"Benchmark did not finish in {timeout}s")
+            time.sleep(0.1)
+        return size / (time.monotonic() - start)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == '__main__':
+    import sys
+
+    # python torrent.py [profile ...] - compare profiles against a local seeder
+    for name in sys.argv[1:] or list(Config.TORRENT_PROFILES):
+        print(f"{name}: {benchmark(name) / 1024 / 1024:.1f} MB/s")
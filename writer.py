@@ -0,0 +1,123 @@
+import os
+import queue
+import asyncio
+import threading
+from config import Config
+
+class FileWriter:
+    """Writes download data to disk from a dedicated, double-buffered I/O thread"""
+
+    def __init__(self, path, truncate=True, buffer_size=None, max_pending=None):
+        self.path = path
+        self.buffer_size = buffer_size or Config.WRITE_BUFFER_SIZE
+        self.written = 0
+        self._buffer = bytearray()
+        self._buffer_offset = 0
+        self._position = 0
+        self._error = None
+        self._closed = False
+        self._loop = asyncio.get_running_loop()
+        self._slots = asyncio.Semaphore(max_pending or Config.WRITE_QUEUE_DEPTH)
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._pending = 0
+        self._queue = queue.SimpleQueue()
+
+        flags = os.O_WRONLY | os.O_CREAT | (os.O_TRUNC if truncate else 0)
+        self._fd = os.open(path, flags, 0o644)
+        self._thread = threading.Thread(target=self._run, name=f"writer:{os.path.basename(path)}", daemon=True)
+        self._thread.start()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close(flush=exc_type is None)
+
+    def _run(self):
+        """Writer thread - drain the queue until the stop marker arrives"""
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            data, offset = item
+            try:
+                if self._error is None:
+                    view = memoryview(data)
+                    while view:
+                        written = os.pwrite(self._fd, view, offset)
+                        view = view[written:]
+                        offset += written
+            except OSError as e:
+                self._error = e
+            finally:
+                self._loop.call_soon_threadsafe(self._done, len(data))
+
+        try:
+            os.close(self._fd)
+        except OSError as e:
+            self._error = self._error or e
+
+    def _done(self, size):
+        """Called on the loop once the thread finished a buffer"""
+        self.written += size
+        self._pending -= 1
+        self._slots.release()
+        if self._pending == 0:
+            self._idle.set()
+
+    async def _submit(self, data, offset):
+        await self._slots.acquire()
+        if self._error:
+            self._slots.release()
+            raise self._error
+        self._pending += 1
+        self._idle.clear()
+        self._queue.put((data, offset))
+
+    async def write(self, data, offset=None):
+        """Queue data for writing - appended and coalesced, or as given at `offset`"""
+        if self._error:
+            raise self._error
+
+        if offset is not None:
+            await self._submit(bytes(data), offset)
+            return
+
+        if not self._buffer:
+            self._buffer_offset = self._position
+        self._buffer += data
+        self._position += len(data)
+        if len(self._buffer) >= self.buffer_size:
+            await self.flush()
+
+    async def flush(self):
+        """Hand the current sequential buffer to the writer thread"""
+        if self._buffer:
+            data, self._buffer = bytes(self._buffer), bytearray()
+            await self._submit(data, self._buffer_offset)
+
+    async def drain(self):
+        """Wait until everything queued so far is on disk"""
+        await self.flush()
+        await self._idle.wait()
+        if self._error:
+            raise self._error
+
+    def truncate(self, size):
+        """Set the file size, e.g. to preallocate a sparse file"""
+        os.ftruncate(self._fd, size)
+
+    async def close(self, flush=True):
+        """Flush pending data and stop the writer thread"""
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            if flush:
+                await self.drain()
+        finally:
+            self._queue.put(None)
+            await self._loop.run_in_executor(None, self._thread.join)
+        if flush and self._error:
+            raise self._error
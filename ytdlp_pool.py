@@ -0,0 +1,406 @@
+import os
+import sys
+import time
+import queue
+import pickle
+import struct
+import asyncio
+import threading
+from config import Config
+
+# Frames on the worker pipes: 4-byte big-endian length, then a pickle
+HEADER = struct.Struct('>I')
+
+class WorkerCrashed(Exception):
+    """A worker process died while running a job"""
+
+def probe_video(report, url, ydl_opts):
+    """Worker job - extract a URL's info and pick its format without downloading"""
+    import yt_dlp
+
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        return ydl.sanitize_info(ydl.extract_info(url, download=False))
+
+def download_video(report, url, ydl_opts, download_dir, url_hash, info=None):
+    """Worker job - download a URL with yt-dlp, returns (filepath, title)"""
+    import yt_dlp
+
+    last_sent = 0
+
+    def hook(d):
+        nonlocal last_sent
+        report()
+        now = time.monotonic()
+        # Hooks fire for every block or fragment, only the newest sample per
+        # interval is sent - plus every status change so none gets lost
+        if d.get('status') != 'downloading' or now - last_sent >= Config.YTDLP_PROGRESS_INTERVAL:
+            last_sent = now
+            report({
+                'status': d.get('status'),
+                'downloaded_bytes': d.get('downloaded_bytes') or 0,
+                'total_bytes': d.get('total_bytes') or d.get('total_bytes_estimate') or 0,
+                'speed': d.get('speed'),
+                'eta': d.get('eta'),
+                'fragment_index': d.get('fragment_index'),
+                'fragment_count': d.get('fragment_count'),
+            })
+
+    def postprocessor_hook(d):
+        report()
+        if d.get('status') == 'started':
+            report({'status': 'postprocessing', 'postprocessor': d.get('postprocessor')})
+
+    ydl_opts = dict(ydl_opts, progress_hooks=[hook], postprocessor_hooks=[postprocessor_hook])
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        try:
+            if info is not None:
+                info = ydl.process_ie_result(info, download=True)
+            else:
+                info = ydl.extract_info(url, download=True)
+            filename = ydl.prepare_filename(info)
+
+            # Check multiple possible output files
+            base = os.path.splitext(filename)[0]
+            possible_files = [
+                filename,
+                f"{base}.mp4",
+                f"{base}.mkv",
+                f"{base}.webm",
+            ]
+
+            # Also check the directory for the most recent file with our hash
+            for file in os.listdir(download_dir):
+                if url_hash in file and file.endswith(('.mp4', '.mkv', '.webm')):
+                    possible_files.append(os.path.join(download_dir, file))
+
+            for pfile in possible_files:
+                if os.path.exists(pfile):
+                    return pfile, info.get('title', 'Video')
+
+            return filename, info.get('title', 'Video')
+
+        except yt_dlp.utils.DownloadCancelled:
+            for file in os.listdir(download_dir):
+                if url_hash in file:
+                    try:
+                        os.remove(os.path.join(download_dir, file))
+                    except OSError:
+                        pass
+            raise
+        except yt_dlp.utils.DownloadError as e:
+            error_msg = str(e)
+            # Check if it's a TikTok-specific error
+            if 'TikTok' in error_msg:
+                raise Exception(f"TikTok download failed - the video may be private, geo-restricted, or unavailable. Try updating yt-dlp: pip install -U yt-dlp")
+            raise
+
+def rebuild_error(name, message):
+    """Turn an error reported by a worker back into an exception"""
+    import yt_dlp
+
+    cls = getattr(yt_dlp.utils, name, None)
+    if isinstance(cls, type) and issubclass(cls, Exception):
+        try:
+            return cls(message)
+        except Exception:
+            pass
+    return Exception(message)
+
+class ProgressRelay:
+    """Passes a job's newest progress to an async callback without holding up the pipe"""
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.latest = None
+        self._task = None
+
+    def post(self, data):
+        self.latest = data
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._deliver())
+
+    async def _deliver(self):
+        while self.latest is not None:
+            data, self.latest = self.latest, None
+            try:
+                await self.callback(data)
+            except Exception as e:
+                print(f"yt-dlp progress error: {e}")
+
+    async def close(self):
+        """Deliver what is still pending"""
+        if self._task is not None:
+            await asyncio.shield(self._task)
+
+class Worker:
+    """One warm worker process and its pipes"""
+
+    def __init__(self, process):
+        self.process = process
+        self.jobs = 0
+
+    @property
+    def alive(self):
+        return self.process.returncode is None
+
+    async def send(self, message):
+        data = pickle.dumps(message)
+        self.process.stdin.write(HEADER.pack(len(data)) + data)
+        await self.process.stdin.drain()
+
+    async def receive(self):
+        try:
+            size, = HEADER.unpack(await self.process.stdout.readexactly(HEADER.size))
+            return pickle.loads(await self.process.stdout.readexactly(size))
+        except asyncio.IncompleteReadError:
+            await self.process.wait()
+            raise WorkerCrashed(f"yt-dlp worker exited with code {self.process.returncode}")
+
+    async def kill(self):
+        if self.alive:
+            try:
+                self.process.kill()
+            except ProcessLookupError:
+                pass
+        await self.process.wait()
+
+class YtdlpPool:
+    """Bounded pool of worker processes running yt-dlp jobs"""
+
+    def __init__(self, size, max_jobs=0):
+        self.size = size
+        self.max_jobs = max_jobs
+        self._idle = None
+        self._workers = set()
+        self._job_ids = 0
+        self._stopping = False
+
+    def start(self):
+        """Spawn the workers in the background"""
+        if self._idle is not None:
+            return
+        self._stopping = False
+        self._idle = asyncio.Queue()
+        for _ in range(self.size):
+            asyncio.create_task(self._replace())
+
+    async def stop(self):
+        """Let idle workers exit and kill the rest"""
+        if self._idle is None:
+            return
+        self._stopping = True
+        for worker in list(self._workers):
+            if worker.alive:
+                worker.process.stdin.close()
+        for worker in list(self._workers):
+            try:
+                await asyncio.wait_for(worker.process.wait(), timeout=5)
+            except asyncio.TimeoutError:
+                await worker.kill()
+        self._workers.clear()
+        self._idle = None
+
+    async def _spawn(self):
+        """Start a worker process and wait until yt-dlp is imported in it"""
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.abspath(__file__),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE
+        )
+        worker = Worker(process)
+        self._workers.add(worker)
+        try:
+            message = await worker.receive()
+            if message != ('ready',):
+                raise WorkerCrashed(f"yt-dlp worker failed to start: {message!r}")
+        except BaseException:
+            self._workers.discard(worker)
+            await worker.kill()
+            raise
+        return worker
+
+    async def _replace(self, worker=None):
+        """Retire a worker (if given) and put a fresh one in the idle queue"""
+        if worker is not None:
+            self._workers.discard(worker)
+            if worker.alive:
+                worker.process.stdin.close()
+                try:
+                    await asyncio.wait_for(worker.process.wait(), timeout=5)
+                except asyncio.TimeoutError:
+                    await worker.kill()
+        while not self._stopping:
+            try:
+                worker = await self._spawn()
+            except Exception as e:
+                print(f"yt-dlp worker start failed: {e}")
+                await asyncio.sleep(5)
+                continue
+            if self._stopping:
+                await worker.kill()
+            else:
+                self._idle.put_nowait(worker)
+            return
+
+    def _release(self, worker):
+        """Give a worker back after a job"""
+        if self._stopping or not worker.alive:
+            return
+        if self.max_jobs and worker.jobs >= self.max_jobs:
+            asyncio.create_task(self._replace(worker))
+        else:
+            self._idle.put_nowait(worker)
+
+    async def _acquire(self):
+        if self._idle is None:
+            self.start()
+        while True:
+            worker = await self._idle.get()
+            if worker.alive:
+                return worker
+            self._workers.discard(worker)
+            asyncio.create_task(self._replace())
+
+    async def run(self, func, *args, progress=None, token=None):
+        """Run `func(report, *args)` in a worker process and return its result"""
+        worker = await self._acquire()
+        self._job_ids += 1
+        job_id = self._job_ids
+        worker.jobs += 1
+        reading = None
+        cancel_deadline = None
+        message = None
+        relay = ProgressRelay(progress) if progress else None
+        try:
+            await worker.send(('run', job_id, func, args))
+            while message is None:
+                reading = asyncio.ensure_future(worker.receive())
+                # The token is a plain flag, look at it between messages
+                while not reading.done():
+                    await asyncio.wait({reading}, timeout=0.5)
+                    if reading.done() or token is None or not token.cancelled:
+                        continue
+                    if cancel_deadline is None:
+                        cancel_deadline = time.monotonic() + Config.YTDLP_CANCEL_GRACE
+                        await worker.send(('cancel', job_id))
+                    elif time.monotonic() > cancel_deadline:
+                        message = ('error', 'DownloadCancelled', "Cancelled by user")
+                        break
+                if message is not None:
+                    # Worker ignored the cancel - stuck somewhere yt-dlp never calls back
+                    reading.cancel()
+                    await self._discard(worker)
+                    break
+                received = reading.result()
+                reading = None
+                if received[0] == 'progress':
+                    if relay:
+                        relay.post(received[1])
+                else:
+                    message = received
+                    self._release(worker)
+        except (WorkerCrashed, ConnectionError):
+            self._workers.discard(worker)
+            asyncio.create_task(self._replace())
+            raise
+        except asyncio.CancelledError:
+            asyncio.create_task(self._abandon(worker, job_id, reading))
+            raise
+
+        if relay:
+            await relay.close()
+        if message[0] == 'error':
+            raise rebuild_error(message[1], message[2])
+        return message[1]
+
+    async def _discard(self, worker):
+        """Kill a worker and start a replacement"""
+        self._workers.discard(worker)
+        await worker.kill()
+        asyncio.create_task(self._replace())
+
+    async def _abandon(self, worker, job_id, reading=None):
+        """Stop the job of a cancelled caller, killing the worker if it won't"""
+        try:
+            if reading is None:
+                reading = asyncio.ensure_future(worker.receive())
+            await worker.send(('cancel', job_id))
+            deadline = time.monotonic() + Config.YTDLP_CANCEL_GRACE
+            while True:
+                message = await asyncio.wait_for(reading, timeout=max(0, deadline - time.monotonic()))
+                if message[0] in ('result', 'error'):
+                    self._release(worker)
+                    return
+                reading = asyncio.ensure_future(worker.receive())
+        except (asyncio.TimeoutError, WorkerCrashed, ConnectionError):
+            if reading is not None:
+                reading.cancel()
+            await self._discard(worker)
+
+def worker_main():
+    """Worker process - run jobs from stdin, report on the original stdout"""
+    out = os.fdopen(os.dup(1), 'wb')
+    os.dup2(2, 1)
+    inp = sys.stdin.buffer
+    send_lock = threading.Lock()
+
+    def send(message):
+        data = pickle.dumps(message)
+        with send_lock:
+            out.write(HEADER.pack(len(data)) + data)
+            out.flush()
+
+    def read():
+        header = inp.read(HEADER.size)
+        if len(header) < HEADER.size:
+            return None
+        size, = HEADER.unpack(header)
+        return pickle.loads(inp.read(size))
+
+    import yt_dlp
+
+    jobs = queue.SimpleQueue()
+    cancelled = threading.Event()
+    current = None
+
+    # Commands are read on a thread so a cancel arrives while a job runs
+    def read_commands():
+        while True:
+            message = read()
+            if message is None:
+                jobs.put(None)
+                return
+            if message[0] == 'cancel':
+                if message[1] == current:
+                    cancelled.set()
+            else:
+                jobs.put(message)
+
+    threading.Thread(target=read_commands, name="ytdlp-commands", daemon=True).start()
+    send(('ready',))
+
+    def report(data=None):
+        if cancelled.is_set():
+            raise yt_dlp.utils.DownloadCancelled("Cancelled by user")
+        if data is not None:
+            send(('progress', data))
+
+    while True:
+        message = jobs.get()
+        if message is None:
+            break
+        _, job_id, func, args = message
+        cancelled.clear()
+        current = job_id
+        try:
+            result = func(report, *args)
+            send(('result', result))
+        except BaseException as e:
+            send(('error', type(e).__name__, str(e)))
+        finally:
+            current = None
+
+ytdlp_pool = YtdlpPool(Config.YTDLP_PROCESSES, Config.YTDLP_MAX_JOBS_PER_PROCESS)
+
+if __name__ == '__main__':
+    worker_main()